@@ -1,8 +1,14 @@
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+import json
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+
+from tenacity import RetryCallState, Retrying, stop_after_attempt, wait_random_exponential
 
 from inews.domain import preprocessing, prompts
-from inews.infra import apis, io
-from inews.infra.types import RunEvent, StoryP, SummaryP, UserGroup, VideoP
+from inews.infra import apis, cache, concurrency, io, telemetry
+from inews.infra.types import RunEvent, StoryP, SummaryP, UserGroup, VideoID, VideoP
 
 data_config = io.get_data_config()
 openai_api = apis.get_openai()
@@ -11,16 +17,40 @@ MODEL = "gpt-3.5-turbo-1106"
 TEMPERATURE = 0.7
 
 
+response_cache = cache.ResponseCache(
+    io.LLM_CACHE_LOCAL_PATH, io.LLM_CACHE_S3_PATH, data_config["llm_cache_max_bytes"]
+)
+
+ledger = telemetry.CallsLedger(io.LLM_LEDGER_LOCAL_FILE)
+
+# bounds the number of requests waiting on the api, whichever thread they come from
+in_flight_requests = threading.BoundedSemaphore(data_config["llm_max_in_flight"])
+
+# shared by all threads, recalibrated from the rate limit headers of every response
+rate_limiter = concurrency.AdaptiveRateLimiter(
+    data_config["llm_requests_per_minute"], data_config["llm_tokens_per_minute"]
+)
+
+
+def format_prompt(template: str, **fields) -> str:
+    prompt = template.format(**fields)
+    tokens_count = preprocessing.count_prompt_tokens(template, **fields)
+    preprocessing.remember_estimated_tokens_count(prompt, tokens_count)
+    return prompt
+
+
 def generate_base_summary_prompt(summary: SummaryP, video: VideoP) -> str:
-    return prompts.BASE_SUMMARY.format(
+    return format_prompt(
+        prompts.BASE_SUMMARY,
         video_title=summary.video_info.title,
         channel_name=summary.channel_info.name,
-        transcript=video.transcript.text,
+        transcript=video.transcript.get_text(),
     )
 
 
 def generate_topics_prompt(summary: SummaryP) -> str:
-    return prompts.TOPICS.format(
+    return format_prompt(
+        prompts.TOPICS,
         number_of_topics=data_config["number_of_topics"],
         video_title=summary.video_info.title,
         channel_name=summary.channel_info.name,
@@ -29,7 +59,8 @@ def generate_topics_prompt(summary: SummaryP) -> str:
 
 
 def generate_short_story_prompt(summary: SummaryP) -> str:
-    return prompts.SHORT_STORY.format(
+    return format_prompt(
+        prompts.SHORT_STORY,
         video_title=summary.video_info.title,
         channel_name=summary.channel_info.name,
         summary=summary.base,
@@ -37,7 +68,8 @@ def generate_short_story_prompt(summary: SummaryP) -> str:
 
 
 def generate_title_story_prompt(summary: SummaryP) -> str:
-    return prompts.TITLE_STORY.format(
+    return format_prompt(
+        prompts.TITLE_STORY,
         video_title=summary.video_info.title,
         channel_name=summary.channel_info.name,
         summary=summary.base,
@@ -45,7 +77,8 @@ def generate_title_story_prompt(summary: SummaryP) -> str:
 
 
 def generate_user_story_prompt(summary: SummaryP, user_group: UserGroup) -> str:
-    return prompts.USER_STORY.format(
+    return format_prompt(
+        prompts.USER_STORY,
         user_science_cat=prompts.GROUP_TO_PROMPT[user_group],
         video_title=summary.video_info.title,
         channel_name=summary.channel_info.name,
@@ -53,79 +86,326 @@ def generate_user_story_prompt(summary: SummaryP, user_group: UserGroup) -> str:
     )
 
 
+def generate_story_prompt(summary: SummaryP, user_groups: list[UserGroup]) -> str:
+    user_science_cats = ", ".join(
+        f"{prompts.GROUP_TO_PROMPT[user_group]}-level" for user_group in user_groups
+    )
+    return format_prompt(
+        prompts.STORY,
+        number_of_user_stories=len(user_groups),
+        user_science_cats=user_science_cats,
+        video_title=summary.video_info.title,
+        channel_name=summary.channel_info.name,
+        summary=summary.base,
+    )
+
+
 def generate_stories_selection_from_topics_prompt(summaries: list[SummaryP]) -> str:
     topics = ""
     for idx, summary in enumerate(summaries):
         topics += f"\n{str(idx + 1)}. {summary.topics}\n"
-    return prompts.STORIES_SELECTION_FROM_TOPICS.format(topics=topics)
+    return format_prompt(prompts.STORIES_SELECTION_FROM_TOPICS, topics=topics)
 
 
 def generate_newsletter_summary_prompt(stories: list[StoryP]) -> str:
     titles_and_shorts = ""
     for idx, story in enumerate(stories):
         titles_and_shorts += f"\n{str(idx + 1)}. {story.title}\n{story.short}\n"
-    return prompts.NEWSLETTER_SUMMARY.format(titles_and_shorts=titles_and_shorts)
-
-
-@retry(wait=wait_random_exponential(min=10, max=60), stop=stop_after_attempt(5))
-def chat_completion(model: str, temperature: float, messages: list[dict]) -> dict:
-    return openai_api.ChatCompletion.create(
-        model=model,
-        temperature=temperature,
-        messages=messages,
+    return format_prompt(prompts.NEWSLETTER_SUMMARY, titles_and_shorts=titles_and_shorts)
+
+
+def create_chat_completion(
+    model: str, temperature: float, messages: list[dict], estimated_tokens: int, **kwargs
+):
+    rate_limiter.acquire(estimated_tokens + data_config["llm_completion_tokens_estimate"])
+    params = {"model": model, "temperature": temperature, "messages": messages, **kwargs}
+    with in_flight_requests:
+        # the requestor is used directly since ChatCompletion.create drops the response headers
+        requestor = openai_api.api_requestor.APIRequestor()
+        try:
+            response, _, api_key = requestor.request("post", "/chat/completions", params)
+        except openai_api.error.OpenAIError as error:
+            rate_limiter.update(error.headers)
+            raise
+
+    rate_limiter.update(response._headers)
+    return openai_api.util.convert_to_openai_object(response, api_key)
+
+
+def wait_for_rate_limit(retry_state: RetryCallState) -> float:
+    error = retry_state.outcome.exception()
+    if isinstance(error, openai_api.error.OpenAIError):
+        retry_after = concurrency.get_retry_after(error.headers)
+        if retry_after is not None:
+            return retry_after
+    return wait_random_exponential(min=1, max=60)(retry_state)
+
+
+def chat_completion(
+    model: str, temperature: float, messages: list[dict], estimated_tokens: int, **kwargs
+) -> tuple[dict, dict]:
+    """Returns the completion along with the retries statistics of the call."""
+    retrying = Retrying(wait=wait_for_rate_limit, stop=stop_after_attempt(5))
+    completion = retrying(
+        create_chat_completion, model, temperature, messages, estimated_tokens, **kwargs
     )
-
-
-def get_model_response(prompt: str) -> str:
+    return completion, retrying.statistics
+
+
+def get_cost(prompt_tokens: int, completion_tokens: int, batch: bool = False) -> float:
+    prices = data_config["llm_prices_per_1k_tokens"]
+    cost = (prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1000
+    return cost * data_config["llm_batch_price_ratio"] if batch else cost
+
+
+def request_api(method: str, url: str, params: dict | None = None) -> dict:
+    requestor = openai_api.api_requestor.APIRequestor()
+    response, _, _ = requestor.request(method, url, params)
+    return response.data
+
+
+class BatchRequests:
+    """Offline execution mode for stages that don't need interactive latency.
+    Requests are collected during a run and submitted as a single batch job at its end. Later
+    runs poll the submitted jobs and fill the responses cache with their results, from which
+    the artifacts are then built as usual."""
+
+    def __init__(self, state_file: Path):
+        self.state_file = state_file
+        self.enabled = False
+        self.requests = {}
+        self.submitted = []
+        self.lock = threading.Lock()
+
+    def configure(self, enabled: bool) -> None:
+        self.enabled = enabled
+        if self.state_file.is_file():
+            self.submitted = io.load_from_json_file(self.state_file)["submitted"]
+
+    def save(self) -> None:
+        io.save_to_json_file({"submitted": self.submitted}, self.state_file)
+
+    def accepts(self, stage: str) -> bool:
+        return self.enabled and stage in data_config["llm_batch_stages"]
+
+    def add(self, key: str, body: dict, stage: str, video_id: VideoID | None) -> None:
+        with self.lock:
+            submitted_keys = {key for batch in self.submitted for key in batch["keys"]}
+            if key not in submitted_keys:
+                self.requests[key] = {"body": body, "stage": stage, "video_id": video_id}
+
+    def submit(self) -> None:
+        if len(self.requests) == 0:
+            return
+
+        lines = [
+            json.dumps(
+                {
+                    "custom_id": key,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": request["body"],
+                }
+            )
+            for key, request in self.requests.items()
+        ]
+        input_file = openai_api.File.create(
+            file=BytesIO("\n".join(lines).encode("utf-8")),
+            purpose="batch",
+            user_provided_filename="inews_batch.jsonl",
+        )
+        batch = request_api(
+            "post",
+            "/batches",
+            {
+                "input_file_id": input_file.id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            },
+        )
+        # the stage and video of each request, to attribute the results in the ledger
+        calls = {
+            key: {"stage": request["stage"], "video_id": request["video_id"]}
+            for key, request in self.requests.items()
+        }
+        self.submitted.append({"id": batch["id"], "keys": list(self.requests), "calls": calls})
+        print(f"LLM batch {batch['id']} submitted: {len(self.requests)} requests")
+        self.requests = {}
+        self.save()
+
+    def collect(self, wait_seconds: float = 0) -> None:
+        deadline = time.monotonic() + wait_seconds
+        collected = False
+        while True:
+            in_progress = []
+            for submitted_batch in self.submitted:
+                batch = request_api("get", f"/batches/{submitted_batch['id']}")
+                if batch["status"] in {"completed", "failed", "expired", "cancelled"}:
+                    collected = True
+                    responses_count = self.fill_cache(
+                        batch.get("output_file_id"), submitted_batch.get("calls", {})
+                    )
+                    print(
+                        f"LLM batch {batch['id']} {batch['status']}: "
+                        + f"{responses_count}/{len(submitted_batch['keys'])} responses"
+                    )
+                else:
+                    in_progress.append(submitted_batch)
+
+            self.submitted = in_progress
+            if len(in_progress) == 0 or time.monotonic() >= deadline:
+                break
+            time.sleep(data_config["llm_batch_poll_interval"])
+
+        print(f"LLM batches in progress: {len(self.submitted)}")
+        # the state file is only written once batches are submitted or collected
+        if collected:
+            self.save()
+
+    def fill_cache(self, output_file_id: str | None, calls: dict[str, dict]) -> int:
+        if output_file_id is None:
+            return 0
+
+        responses_count = 0
+        output = openai_api.File.download(output_file_id).decode("utf-8")
+        for line in output.splitlines():
+            result = json.loads(line)
+            response = result.get("response")
+            if result.get("error") is not None or response is None:
+                continue
+            if response["status_code"] != 200:
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            response_cache.set(result["custom_id"], content)
+            responses_count += 1
+
+            usage = response["body"]["usage"]
+            # batches submitted before the calls were kept are recorded as a whole
+            call = calls.get(result["custom_id"], {"stage": "batch", "video_id": None})
+            ledger.record(
+                stage=call["stage"],
+                video_id=call["video_id"],
+                model=response["body"]["model"],
+                cached=False,
+                batch=True,
+                estimated_prompt_tokens=0,
+                prompt_tokens=usage["prompt_tokens"],
+                completion_tokens=usage["completion_tokens"],
+                wall_time=0,
+                retries=0,
+                retry_wait=0,
+                cost=get_cost(usage["prompt_tokens"], usage["completion_tokens"], batch=True),
+            )
+
+        return responses_count
+
+
+batch_requests = BatchRequests(io.LLM_BATCHES_LOCAL_FILE)
+
+
+def get_model_response(
+    prompt: str, stage: str, video_id: VideoID | None = None, json_mode: bool = False
+) -> str:
+    """Return the model response to prompt, or an empty string if the request has been queued
+    for a batch job."""
     messages = [
         {"role": "system", "content": prompts.SYSTEM_PROMPT},
         {"role": "user", "content": prompt},
     ]
-    messages_tokens_count = preprocessing.count_tokens_from_messages(messages)
-    print(f"Using {MODEL}, tokens: {messages_tokens_count}")
+    params = {"response_format": {"type": "json_object"}} if json_mode else {}
+    call_record = {
+        "stage": stage,
+        "video_id": video_id,
+        "model": MODEL,
+        "cached": False,
+        "batch": False,
+        "estimated_prompt_tokens": preprocessing.count_tokens_from_messages(messages),
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "wall_time": 0,
+        "retries": 0,
+        "retry_wait": 0,
+        "cost": 0,
+    }
+
+    cache_key = response_cache.get_key(
+        model=MODEL, temperature=TEMPERATURE, messages=messages, **params
+    )
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        ledger.record(**call_record | {"cached": True})
+        return cached_response
+
+    if batch_requests.accepts(stage):
+        batch_requests.add(
+            cache_key,
+            {"model": MODEL, "temperature": TEMPERATURE, "messages": messages, **params},
+            stage,
+            video_id,
+        )
+        ledger.record(**call_record | {"batch": True})
+        return ""
 
-    completion = chat_completion(
+    print(f"Using {MODEL} for {stage}, tokens: {call_record['estimated_prompt_tokens']}")
+    start = time.perf_counter()
+    completion, retries_statistics = chat_completion(
         model=MODEL,
         temperature=TEMPERATURE,
         messages=messages,
+        estimated_tokens=call_record["estimated_prompt_tokens"],
+        **params,
+    )
+    usage = completion.usage
+    ledger.record(
+        **call_record
+        | {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "wall_time": time.perf_counter() - start,
+            "retries": retries_statistics["attempt_number"] - 1,
+            "retry_wait": retries_statistics["idle_for"],
+            "cost": get_cost(usage.prompt_tokens, usage.completion_tokens),
+        }
     )
 
-    return completion.choices[0].message.content
+    response = completion.choices[0].message.content
+    response_cache.set(cache_key, response)
+    return response
 
 
 def get_base_summary(summary: SummaryP, video: VideoP, run: RunEvent) -> str:
     if run.dummy_llm_requests:
         return "This is a base summary"
     prompt = generate_base_summary_prompt(summary, video)
-    return get_model_response(prompt)
+    return get_model_response(prompt, "base", summary.video_info.id)
 
 
 def get_topics(summary: SummaryP, run: RunEvent) -> str:
     if run.dummy_llm_requests:
         return "This is a list of topics"
     prompt = generate_topics_prompt(summary)
-    return get_model_response(prompt)
+    return get_model_response(prompt, "topics", summary.video_info.id)
 
 
 def get_stories_selection_from_topics(summaries: list[SummaryP], run: RunEvent) -> list[str]:
     if run.dummy_llm_requests:
-        return ["no", "yes", "no", "yes"]
+        return [["no", "yes"][idx % 2] for idx in range(len(summaries))]
     prompt = generate_stories_selection_from_topics_prompt(summaries)
-    return get_model_response(prompt).lower().split(",")
+    return get_model_response(prompt, "selection").lower().split(",")
 
 
 def get_short_summary(summary: SummaryP, run: RunEvent) -> str:
     if run.dummy_llm_requests:
         return "This is a short story"
     prompt = generate_short_story_prompt(summary)
-    return get_model_response(prompt)
+    return get_model_response(prompt, "short", summary.video_info.id)
 
 
 def get_title_summary(summary: SummaryP, run: RunEvent) -> str:
     if run.dummy_llm_requests:
         return "This is a title story"
     prompt = generate_title_story_prompt(summary)
-    return get_model_response(prompt)
+    return get_model_response(prompt, "title", summary.video_info.id)
 
 
 def get_user_story(summary: SummaryP, user_group: UserGroup, run: RunEvent) -> str:
@@ -135,11 +415,43 @@ def get_user_story(summary: SummaryP, user_group: UserGroup, run: RunEvent) -> s
             + "-level scientific background"
         )
     prompt = generate_user_story_prompt(summary, user_group)
-    return get_model_response(prompt)
+    return get_model_response(prompt, "user_story", summary.video_info.id)
+
+
+def get_story(summary: SummaryP, user_groups: list[UserGroup], run: RunEvent) -> dict:
+    """Request short, title and every user story in a single structured completion.
+    The returned fields are not validated, an empty dict is returned if the answer isn't json."""
+    if run.dummy_llm_requests:
+        return {
+            "short": get_short_summary(summary, run),
+            "title": get_title_summary(summary, run),
+            "user_stories": [
+                {"user_group": user_group, "user_story": get_user_story(summary, user_group, run)}
+                for user_group in user_groups
+            ],
+        }
+
+    prompt = generate_story_prompt(summary, user_groups)
+    response = get_model_response(prompt, "story", summary.video_info.id, json_mode=True)
+    try:
+        fields = json.loads(response)
+    except json.JSONDecodeError:
+        return {}
+
+    if not isinstance(fields, dict):
+        return {}
+
+    user_stories = fields.get("user_stories")
+    if isinstance(user_stories, list):
+        fields["user_stories"] = [
+            {"user_group": user_group, "user_story": user_story}
+            for user_group, user_story in zip(user_groups, user_stories, strict=False)
+        ]
+    return fields
 
 
 def get_newsletter_summary(stories: list[StoryP], run: RunEvent) -> str:
     if run.dummy_llm_requests:
         return "This is a newsletter summary"
     prompt = generate_newsletter_summary_prompt(stories)
-    return get_model_response(prompt)
+    return get_model_response(prompt, "newsletter_summary")
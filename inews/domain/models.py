@@ -1,19 +1,23 @@
+import threading
+import time
 from functools import cached_property
 from pathlib import Path
+from typing import Any
 
 import pendulum
 import readtime
-from pydantic import BaseModel, Field, computed_field
+from pydantic import BaseModel, Field, PrivateAttr, RootModel, ValidationError, computed_field
 from youtube_transcript_api._transcripts import Transcript
 
 from inews.domain import html, llm, mailing, preprocessing, youtube
-from inews.infra import io
+from inews.infra import apis, io
 from inews.infra.types import (
     ChannelID,
     PendulumDateTime,
     RunEvent,
     UserGroup,
     VideoID,
+    get_trusted_constructor,
     pprint_repr,
 )
 
@@ -24,6 +28,22 @@ mailing_config = io.get_mailing_config()
 BaseModel.__repr__ = pprint_repr
 
 
+def is_trusted(data: dict) -> bool:
+    return data_config["trusted_fast_load"] and data.get("schema_version") == io.SCHEMA_VERSION
+
+
+def load_models(model: type[BaseModel], datas: list[dict]) -> list[BaseModel]:
+    """Build models from loaded state items, without validation for the items the pipeline wrote
+    with the current schema version."""
+    construct = get_trusted_constructor(model)
+    return [construct(data) if is_trusted(data) else model.model_validate(data) for data in datas]
+
+
+class TranscriptInfo(BaseModel):
+    tokens_count: int
+    is_generated: bool
+
+
 class VideoInfo(BaseModel):
     id: VideoID
     channel_id: ChannelID
@@ -32,6 +52,7 @@ class VideoInfo(BaseModel):
     duration: str
     thumbnail_url: str
     use: bool = True
+    transcript: TranscriptInfo | None = None  # metadata of the saved transcript
 
     @cached_property
     def is_not_short(self) -> bool:
@@ -46,20 +67,102 @@ class VideoInfo(BaseModel):
         return self.is_not_short and self.is_recent
 
 
+class VideosState(RootModel):
+    """Videos state keyed by id. Videos are added, removed and updated in place and only the
+    changed ones are written when the state is flushed."""
+
+    root: dict[VideoID, VideoInfo] = Field(default_factory=dict)
+    _changed_ids: set[VideoID] = PrivateAttr(default_factory=set)
+    _removed_ids: set[VideoID] = PrivateAttr(default_factory=set)
+
+    @classmethod
+    def init_from_file(cls):
+        videos_info = load_models(VideoInfo, io.load_state("videos"))
+        return cls({vinfo.id: vinfo for vinfo in videos_info})
+
+    def __len__(self):
+        return len(self.root)
+
+    def __iter__(self):
+        return iter(list(self.root.values()))
+
+    def __contains__(self, video_id: VideoID) -> bool:
+        return video_id in self.root
+
+    def add(self, video_info: VideoInfo) -> None:
+        self.root[video_info.id] = video_info
+        self._changed_ids.add(video_info.id)
+        self._removed_ids.discard(video_info.id)
+
+    def remove(self, video_id: VideoID) -> None:
+        if self.root.pop(video_id, None) is not None:
+            self._changed_ids.discard(video_id)
+            self._removed_ids.add(video_id)
+
+    def set_use(self, video_id: VideoID, use: bool) -> None:
+        if self.root[video_id].use != use:
+            self.root[video_id].use = use
+            self._changed_ids.add(video_id)
+
+    def set_transcript(self, video_id: VideoID, transcript: TranscriptInfo | None) -> None:
+        if transcript is not None and self.root[video_id].transcript != transcript:
+            self.root[video_id].transcript = transcript.model_copy()
+            self._changed_ids.add(video_id)
+
+    @property
+    def changes_count(self) -> int:
+        return len(self._changed_ids) + len(self._removed_ids)
+
+    def flush(self) -> None:
+        if self.changes_count == 0:
+            return
+        # in the state order, the same changes are always written the same way
+        changed_states = [
+            video_info.model_dump(mode="json")
+            for video_id, video_info in self.root.items()
+            if video_id in self._changed_ids
+        ]
+        io.update_state("videos", changed_states, sorted(self._removed_ids))
+        self._changed_ids = set()
+        self._removed_ids = set()
+
+
 class ChannelInfo(BaseModel):
     id: ChannelID
     name: str
     uploads_playlist_id: str
+    playlist_etag: str | None = None
+    last_video_id: VideoID | None = None
+    last_video_date: PendulumDateTime | None = None
 
 
-class ProcessedTranscript(BaseModel):
-    tokens_count: int
-    is_generated: bool
-    text: str
+class ProcessedTranscript(TranscriptInfo):
+    text: str | None = None  # None until read from the transcript artifact
+    _video_info: VideoInfo | None = PrivateAttr(default=None)
+
+    @classmethod
+    def init_from_state(cls, video_info: VideoInfo):
+        transcript = cls.model_validate(video_info.transcript.model_dump())
+        transcript._video_info = video_info
+        return transcript
+
+    @property
+    def info(self) -> TranscriptInfo:
+        return TranscriptInfo(tokens_count=self.tokens_count, is_generated=self.is_generated)
+
+    def get_text(self) -> str:
+        """Text of the transcript, read from its artifact (and not kept) when the transcript was
+        built from the videos state."""
+        if self.text is not None:
+            return self.text
+        json_data = io.load_artifact("transcripts", self._video_info)
+        text = json_data["transcript"]["text"]
+        preprocessing.remember_tokens_count(text, self.tokens_count)
+        return text
 
     @classmethod
     def init_from_transcript(cls, transcript: Transcript):
-        raw_transcript = transcript.fetch()
+        raw_transcript = youtube.fetch_transcript(transcript)
         text = preprocessing.format_transcript(raw_transcript)
         tokens_count = preprocessing.count_tokens(text)
         return cls(tokens_count=tokens_count, is_generated=transcript.is_generated, text=text)
@@ -69,23 +172,44 @@ class Video(BaseModel):
     info: VideoInfo
     channel_info: ChannelInfo
     transcript: ProcessedTranscript | None = None
+    transcript_miss: str | None = None
     allow_requests: bool = True
 
     @classmethod
     def init_from_file(cls, video_info: VideoInfo):
-        file_path = io.TRANSCRIPTS_LOCAL_PATH / io.get_file_name(video_info)
-        json_data = io.load_from_json_file(file_path)
+        json_data = io.load_artifact("transcripts", video_info)
         video = cls.model_validate(json_data)
         video.allow_requests = False
+        if video.transcript is not None:
+            preprocessing.remember_tokens_count(
+                video.transcript.text, video.transcript.tokens_count
+            )
+            # recorded in the videos state, the next runs read the text lazily
+            video.info.transcript = video.transcript.info
         return video
 
+    @classmethod
+    def init_from_state(cls, video_info: VideoInfo, channel_info: ChannelInfo):
+        """A video whose transcript is saved, without reading the transcript text."""
+        return cls(
+            info=video_info,
+            channel_info=channel_info,
+            transcript=ProcessedTranscript.init_from_state(video_info),
+            allow_requests=False,
+        )
+
     def get_available_transcript(self) -> None:
         if not self.allow_requests:
             return
 
-        available_transcript = youtube.get_available_transcript(self.info.id)
-        if available_transcript is not None:
-            self.transcript = ProcessedTranscript.init_from_transcript(available_transcript)
+        try:
+            available_transcript = youtube.get_available_transcript(self.info.id)
+        except apis.TranscriptError as error:
+            self.transcript_miss = type(error).__name__
+            return
+
+        self.transcript = ProcessedTranscript.init_from_transcript(available_transcript)
+        self.info.transcript = self.transcript.info
 
     @cached_property
     def valid_transcript(self) -> bool:
@@ -98,8 +222,179 @@ class Video(BaseModel):
             )
 
     def save(self) -> None:
-        file_path = io.TRANSCRIPTS_LOCAL_PATH / io.get_file_name(self.info)
-        io.save_to_json_file(self.model_dump(mode="json", exclude={"allow_requests"}), file_path)
+        io.save_artifact(
+            "transcripts",
+            self.model_dump(mode="json", exclude={"allow_requests", "transcript_miss"}),
+        )
+
+
+class TranscriptMiss(BaseModel):
+    reason: str
+    attempts: int = 0
+    first_seen: PendulumDateTime = Field(default_factory=pendulum.now)
+    next_attempt: PendulumDateTime = Field(default_factory=pendulum.now)
+
+    def record_attempt(self, reason: str) -> None:
+        self.reason = reason
+        self.attempts += 1
+        if reason == "TranscriptsDisabled":
+            # won't be retried until it expires
+            self.next_attempt = self.expires_at
+        else:
+            # captions are likely not ready yet
+            retry_hours = data_config["transcripts_retry_hours"]
+            delay = retry_hours[min(self.attempts, len(retry_hours)) - 1]
+            self.next_attempt = pendulum.now().add(hours=delay)
+
+    @property
+    def expires_at(self) -> pendulum.DateTime:
+        return self.first_seen.add(days=data_config["transcripts_misses_ttl_days"])
+
+    @property
+    def is_expired(self) -> bool:
+        return pendulum.now() >= self.expires_at
+
+    @property
+    def is_pending(self) -> bool:
+        return pendulum.now() < self.next_attempt
+
+
+class TranscriptsMisses(RootModel):
+    root: dict[VideoID, TranscriptMiss] = Field(default_factory=dict)
+
+    @classmethod
+    def init_from_file(cls):
+        if not io.TRANSCRIPTS_MISSES_LOCAL_FILE.is_file():
+            return cls()
+        json_data = io.load_from_json_file(io.TRANSCRIPTS_MISSES_LOCAL_FILE)
+        misses = cls.model_validate(json_data)
+        misses.prune()
+        return misses
+
+    def __len__(self):
+        return len(self.root)
+
+    def is_pending(self, video_id: VideoID) -> bool:
+        return video_id in self.root and self.root[video_id].is_pending
+
+    def is_retry_due(self, video_id: VideoID) -> bool:
+        return video_id in self.root and not self.root[video_id].is_pending
+
+    def record(self, video: Video) -> None:
+        if video.transcript is not None:
+            self.root.pop(video.info.id, None)
+        elif video.transcript_miss is not None:
+            miss = self.root.setdefault(video.info.id, TranscriptMiss(reason=video.transcript_miss))
+            miss.record_attempt(video.transcript_miss)
+
+    def prune(self) -> None:
+        self.root = {id: miss for id, miss in self.root.items() if not miss.is_expired}
+
+    def save(self) -> None:
+        io.save_to_json_file(self.model_dump(mode="json"), io.TRANSCRIPTS_MISSES_LOCAL_FILE)
+
+
+class VideoProgress(BaseModel):
+    transcript: bool | None = None  # whether the video is still used after its transcript step
+    transcript_miss: str | None = None
+    base: str = ""
+    topics: str = ""
+    selected: bool | None = None
+    story: dict[str, Any] = Field(default_factory=dict)  # story fields generated so far
+
+
+class NewsletterProgress(BaseModel):
+    issue_number: int
+    stories_ids: list[VideoID]
+    summary: str
+
+
+class RunJournal(BaseModel):
+    """Steps completed per video by the current data run, saved after each step so that a run
+    interrupted by the lambda timeout resumes at the first incomplete one. The newsletter summary
+    is kept across runs, for the issue and stories it was generated for."""
+
+    run_id: str = Field(default_factory=lambda: pendulum.now("UTC").format("YYYYMMDDTHHmmss"))
+    completed: bool = False
+    videos: dict[VideoID, VideoProgress] = Field(default_factory=dict)
+    newsletter: NewsletterProgress | None = None
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _bucket_name: str | None = PrivateAttr(default=None)
+    _push_interval: float = PrivateAttr(default=0)
+    _pushed_at: float = PrivateAttr(default=0)
+
+    @classmethod
+    def init_from_file(cls):
+        if not io.RUN_JOURNAL_LOCAL_FILE.is_file():
+            return cls()
+        return cls.model_validate(io.load_from_json_file(io.RUN_JOURNAL_LOCAL_FILE))
+
+    @classmethod
+    def init_for_run(cls):
+        """The journal of the interrupted run, or a new one if the last run completed."""
+        journal = cls.init_from_file()
+        if journal.completed:
+            journal = cls(newsletter=journal.newsletter)
+        return journal
+
+    def configure_bucket(self, bucket_name: str, push_interval: float) -> None:
+        """Upload the journal to the bucket as it is saved, at most once per push_interval."""
+        self._bucket_name = bucket_name
+        self._push_interval = push_interval
+
+    def get(self, video_id: VideoID) -> VideoProgress:
+        with self._lock:
+            return self.videos.get(video_id, VideoProgress()).model_copy(deep=True)
+
+    def record(self, video_id: VideoID, **steps: Any) -> None:
+        with self._lock:
+            progress = self.videos.setdefault(video_id, VideoProgress())
+            for step, result in steps.items():
+                setattr(progress, step, result)
+            self.save_locked()
+
+    def record_selection(self, decisions: dict[VideoID, bool]) -> None:
+        with self._lock:
+            for video_id, selected in decisions.items():
+                self.videos.setdefault(video_id, VideoProgress()).selected = selected
+            self.save_locked()
+
+    def get_newsletter_summary(self, issue_number: int, stories_ids: list[VideoID]) -> str:
+        newsletter = self.newsletter
+        if newsletter is None or newsletter.issue_number != issue_number:
+            return ""
+        return newsletter.summary if newsletter.stories_ids == stories_ids else ""
+
+    def record_newsletter_summary(
+        self, issue_number: int, stories_ids: list[VideoID], summary: str
+    ) -> None:
+        with self._lock:
+            self.newsletter = NewsletterProgress(
+                issue_number=issue_number, stories_ids=stories_ids, summary=summary
+            )
+            self.save_locked()
+
+    def complete(self) -> None:
+        with self._lock:
+            self.completed = True
+            self._pushed_at = 0
+            self.save_locked()
+
+    def save_locked(self) -> None:
+        # called with the lock held
+        io.save_to_json_file(self.model_dump(mode="json"), io.RUN_JOURNAL_LOCAL_FILE)
+        if (
+            self._bucket_name is not None
+            and time.monotonic() - self._pushed_at >= self._push_interval
+        ):
+            io.push_file_to_bucket(
+                self._bucket_name, io.RUN_JOURNAL_LOCAL_FILE, io.RUN_JOURNAL_S3_FILE
+            )
+            self._pushed_at = time.monotonic()
+
+    def stats(self) -> str:
+        state = "new run" if len(self.videos) == 0 else f"resuming {len(self.videos)} videos"
+        return f"Run journal {self.run_id}: {state}"
 
 
 class Summary(BaseModel):
@@ -111,8 +406,7 @@ class Summary(BaseModel):
 
     @classmethod
     def init_from_file(cls, video_info: VideoInfo):
-        file_path = io.SUMMARIES_LOCAL_PATH / io.get_file_name(video_info)
-        json_data = io.load_from_json_file(file_path)
+        json_data = io.load_artifact("summaries", video_info)
         summary = cls.model_validate(json_data)
         summary.allow_requests = False
         return summary
@@ -122,16 +416,19 @@ class Summary(BaseModel):
         return cls(video_infos=video.info, channel_infos=video.channel_info)
 
     def get_base_from_video(self, video: Video, run: RunEvent) -> None:
-        if self.allow_requests:
+        if self.allow_requests and not self.base:
             self.base = llm.get_base_summary(self, video, run)
 
     def get_topics(self, run: RunEvent) -> None:
-        if self.allow_requests:
+        if self.allow_requests and self.base and not self.topics:
             self.topics = llm.get_topics(self, run)
 
+    @property
+    def is_complete(self) -> bool:
+        return bool(self.base and self.topics)
+
     def save(self) -> None:
-        file_path = io.SUMMARIES_LOCAL_PATH / io.get_file_name(self.video_info)
-        io.save_to_json_file(self.model_dump(mode="json", exclude={"allow_requests"}), file_path)
+        io.save_artifact("summaries", self.model_dump(mode="json", exclude={"allow_requests"}))
 
 
 class User(BaseModel):
@@ -155,8 +452,7 @@ class Story(BaseModel):
 
     @classmethod
     def init_from_file(cls, video_info: VideoInfo):
-        file_path = io.STORIES_LOCAL_PATH / io.get_file_name(video_info)
-        json_data = io.load_from_json_file(file_path)
+        json_data = io.load_artifact("stories", video_info)
         story = cls.model_validate(json_data)
         story.allow_requests = False
         return story
@@ -166,23 +462,54 @@ class Story(BaseModel):
         return cls(video_infos=summary.video_info, channel_infos=summary.channel_info)
 
     def get_short_from_summary(self, summary: Summary, run: RunEvent) -> None:
-        if self.allow_requests:
+        if self.allow_requests and not self.short:
             self.short = llm.get_short_summary(summary, run)
 
     def get_title_from_summary(self, summary: Summary, run: RunEvent) -> None:
-        if self.allow_requests:
+        if self.allow_requests and not self.title:
             self.title = llm.get_title_summary(summary, run)
 
     def get_user_groups_from_summary(self, summary: Summary, run: RunEvent) -> None:
         if not self.allow_requests:
             return
+        if self.user_stories and all(user_story.user_story for user_story in self.user_stories):
+            return
 
         user_stories = []
         for group_id, _ in enumerate(mailing_config["mc_group_interest_values"]):
             user_summary = llm.get_user_story(summary, group_id, run)
             user_stories.append(UserStory(user_group=group_id, user_story=user_summary))
         self.user_stories = user_stories
-        self.save()
+
+    def get_all_from_summary(self, summary: Summary, run: RunEvent) -> None:
+        """Generate short, title and user stories in a single request, the fields are left empty
+        if the structured answer doesn't validate."""
+        if not self.allow_requests or self.short or self.title or self.user_stories:
+            return
+
+        user_groups = list(range(len(mailing_config["mc_group_interest_values"])))
+        fields = llm.get_story(summary, user_groups, run)
+        try:
+            story = Story.model_validate(
+                self.model_dump(exclude={"short", "title", "user_stories"}) | fields
+            )
+            if not (story.short and story.title) or len(story.user_stories) != len(user_groups):
+                raise ValueError("Incomplete story")
+            if not all(user_story.user_story for user_story in story.user_stories):
+                raise ValueError("Incomplete user stories")
+        except (ValidationError, ValueError):
+            print(f"Warning: invalid structured story for {self.video_info.id}, using fallback")
+            return
+
+        self.short = story.short
+        self.title = story.title
+        self.user_stories = story.user_stories
+
+    @property
+    def is_complete(self) -> bool:
+        return bool(self.short and self.title) and all(
+            user_story.user_story for user_story in self.user_stories
+        )
 
     def is_too_old(self) -> bool:
         max_days_old = data_config["newsletter_stories_days_old"]
@@ -190,8 +517,7 @@ class Story(BaseModel):
         return (pendulum.today() - story_date).days >= max_days_old
 
     def save(self) -> None:
-        file_path = io.STORIES_LOCAL_PATH / io.get_file_name(self.video_info)
-        io.save_to_json_file(self.model_dump(mode="json", exclude={"allow_requests"}), file_path)
+        io.save_artifact("stories", self.model_dump(mode="json", exclude={"allow_requests"}))
 
 
 class NewsletterInfo(BaseModel):
@@ -1,6 +1,17 @@
+import hashlib
+import os
+from functools import cache
+
 import tiktoken
 from unidecode import unidecode
 
+TOKENS_MODEL = "gpt-3.5-turbo"
+
+# tokens counts memoized by (encoding name, text hash)
+tokens_counts: dict[tuple[str, str], int] = {}
+# estimated tokens counts of formatted prompts, kept apart from the exact counts
+estimated_tokens_counts: dict[tuple[str, str], int] = {}
+
 
 def format_transcript(raw_transcript: list[dict]) -> str:
     transcript = " ".join(line["text"] for line in raw_transcript)
@@ -8,20 +19,78 @@ def format_transcript(raw_transcript: list[dict]) -> str:
     return " ".join(transcript.split())
 
 
-def count_tokens(text: str) -> int:
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    return len(encoding.encode(text))
+@cache
+def get_encoding(model: str = TOKENS_MODEL) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def get_tokens_count_key(text: str, encoding: tiktoken.Encoding) -> tuple[str, str]:
+    return encoding.name, hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def count_tokens_batch(texts: list[str], model: str = TOKENS_MODEL) -> list[int]:
+    """Count tokens of every text, only texts that have not been counted before are encoded
+    (in a single multithreaded batch)."""
+    encoding = get_encoding(model)
+    keys = [get_tokens_count_key(text, encoding) for text in texts]
+    to_encode = {
+        key: text for key, text in zip(keys, texts, strict=True) if key not in tokens_counts
+    }
+    if len(to_encode) > 0:
+        encoded = encoding.encode_ordinary_batch(
+            list(to_encode.values()), num_threads=os.cpu_count() or 1
+        )
+        for key, tokens in zip(to_encode, encoded, strict=True):
+            tokens_counts[key] = len(tokens)
+
+    return [tokens_counts[key] for key in keys]
+
+
+def count_tokens(text: str, model: str = TOKENS_MODEL) -> int:
+    return count_tokens_batch([text], model)[0]
+
+
+def remember_tokens_count(text: str, tokens_count: int, model: str = TOKENS_MODEL) -> None:
+    tokens_counts[get_tokens_count_key(text, get_encoding(model))] = tokens_count
+
+
+def remember_estimated_tokens_count(
+    text: str, tokens_count: int, model: str = TOKENS_MODEL
+) -> None:
+    estimated_tokens_counts[get_tokens_count_key(text, get_encoding(model))] = tokens_count
+
+
+def estimate_tokens_batch(texts: list[str], model: str = TOKENS_MODEL) -> list[int]:
+    """Estimated counts of the texts that have one, exact counts of the others."""
+    encoding = get_encoding(model)
+    keys = [get_tokens_count_key(text, encoding) for text in texts]
+    to_count = [
+        text for key, text in zip(keys, texts, strict=True) if key not in estimated_tokens_counts
+    ]
+    counts = iter(count_tokens_batch(to_count, model))
+    return [
+        estimated_tokens_counts[key] if key in estimated_tokens_counts else next(counts)
+        for key in keys
+    ]
+
+
+def count_prompt_tokens(template: str, model: str = TOKENS_MODEL, **fields) -> int:
+    """Estimate the tokens count of template.format(**fields) from the counts of its components,
+    which are likely to be memoized already (e.g. transcripts or base summaries)."""
+    template_tokens = count_tokens(template.format(**dict.fromkeys(fields, "")), model)
+    fields_tokens = count_tokens_batch([str(value) for value in fields.values()], model)
+    return template_tokens + sum(fields_tokens)
 
 
 def count_tokens_from_messages(messages: list[dict], model: str = "gpt-3.5-turbo-0613") -> int:
-    """Return the number of tokens used by a list of messages for api calls.
+    """Return the number of tokens used by a list of messages for api calls, prompts formatted
+    by llm.format_prompt are counted from their estimate.
     https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -47,11 +116,13 @@ def count_tokens_from_messages(messages: list[dict], model: str = "gpt-3.5-turbo
         raise NotImplementedError(
             f"""count_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
+    values = [value for message in messages for value in message.values()]
+    values_tokens = iter(estimate_tokens_batch(values, model))
     tokens_count = 0
     for message in messages:
         tokens_count += tokens_per_message
-        for key, value in message.items():
-            tokens_count += len(encoding.encode(value))
+        for key in message:
+            tokens_count += next(values_tokens)
             if key == "name":
                 tokens_count += tokens_per_name
     tokens_count += 3  # every reply is primed with <|start|>assistant<|message|>
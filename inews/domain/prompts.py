@@ -110,6 +110,37 @@ Summarized transcript:
 Your summary tailored for the given audience:"""
 
 
+STORY = """You will be given the summarized transcript
+of a youtube video titled "{video_title}" by youtube channel {channel_name}.
+
+Your task is to write 3 different things about this video:
+
+1. short: a very short summary of this video. The length of your summary should
+not exceed 3 sentences. The language should be entice the reader to know more
+about it while remaining factual.
+
+2. title: an alternative title to this video that fully conveys the topic of
+the video. The language should be neutral, factual and not clickbaiting. Do not
+add quotation marks arround your title.
+
+3. user_stories: {number_of_user_stories} short summaries (2-3 paragraphs
+maximum) of this transcript, one for each of the following audiences, in this
+order: {user_science_cats}. Each summary is intended to be read and understood
+by someone with the corresponding level of scientific background. The language
+should be neutral and tailored for this specific audience.
+
+For all of them, do not refer to the video and relate the facts directly.
+
+You will give your answer as a JSON object with the keys "short" (a string),
+"title" (a string) and "user_stories" (a list of {number_of_user_stories}
+strings, in the order of the audiences given above) and nothing else.
+
+Summarized transcript:
+{summary}
+
+Your answer:"""
+
+
 # TODO: testing
 USER_STORY_ALL = """You will be given the summarized transcript
 of a youtube video titled "{video_title}" by youtube channel {channel_name}.
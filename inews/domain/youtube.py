@@ -1,28 +1,59 @@
+from collections.abc import Callable
+
+from googleapiclient.errors import HttpError
 from unidecode import unidecode
 from youtube_transcript_api._transcripts import Transcript
 
-from inews.infra import apis
+from inews.infra import apis, concurrency, io
 from inews.infra.types import ChannelID, VideoID
 
+data_config = io.get_data_config()
 youtube_api = apis.get_youtube()
 yt_transcript_api = apis.get_yt_transcript()
 
+TRANSCRIPTS_HOST = "www.youtube.com"
+transcripts_limiter = concurrency.RateLimiter(
+    requests_per_second=data_config["transcripts_requests_per_second"],
+    burst=data_config["transcripts_burst"],
+    max_per_host=data_config["transcripts_max_per_host"],
+)
+
 
 def chunks(full_list: list, size: int = 50):
     for i in range(0, len(full_list), size):
         yield full_list[i : i + size]
 
 
-def get_channels_info(channels_id: list[ChannelID]) -> list[dict]:
-    if len(channels_id) == 0:
-        return []
+def list_in_chunks(list_items: Callable[[list[str]], list[dict]], ids: list[str]) -> list[dict]:
+    """Run list_items over chunks of ids concurrently and merge the returned items, ordered as
+    in ids (the api does not guarantee any ordering)."""
+    chunks_results = concurrency.thread_map(
+        list_items, chunks(ids), data_config["youtube_max_workers"]
+    )
+    items = [item for chunk_items, _ in chunks_results for item in chunk_items]
+    id_to_idx = {id: idx for idx, id in enumerate(ids)}
+    return sorted(items, key=lambda item: id_to_idx.get(item["id"], len(ids)))
 
+
+def list_channels(channels_id: list[ChannelID]) -> list[dict]:
     request = youtube_api.channels().list(
         part="snippet,contentDetails", id=channels_id, maxResults=50
     )
-    response = request.execute()
+    return request.execute(http=apis.get_thread_http())["items"]
+
+
+def list_videos(videos_ids: list[VideoID]) -> list[dict]:
+    request = youtube_api.videos().list(part="snippet,contentDetails", id=videos_ids)
+    return request.execute(http=apis.get_thread_http())["items"]
+
+
+def get_channels_info(channels_id: list[ChannelID]) -> list[dict]:
+    if len(channels_id) == 0:
+        return []
+
+    response_items = list_in_chunks(list_channels, channels_id)
     channels_infos = []
-    for item in response["items"]:
+    for item in response_items:
         channels_infos.append(
             {
                 "id": item["id"],
@@ -33,21 +64,54 @@ def get_channels_info(channels_id: list[ChannelID]) -> list[dict]:
     return channels_infos
 
 
-def get_channel_recent_videos_ids(uploads_playlist_id: str, max_results: int = 50) -> list[VideoID]:
-    request = youtube_api.playlistItems().list(
-        part="snippet", maxResults=max_results, playlistId=uploads_playlist_id
-    )
-    response = request.execute()
-    videos_id = [item["snippet"]["resourceId"]["videoId"] for item in response["items"]]
-    return videos_id
+def get_channel_new_videos(
+    uploads_playlist_id: str,
+    etag: str | None = None,
+    last_video_id: VideoID | None = None,
+    max_results: int = 50,
+) -> tuple[list[dict], str | None]:
+    """Return the uploads more recent than last_video_id, newest first, along with the playlist
+    etag. The first page is requested conditionally on etag so that an unchanged playlist
+    costs a single empty 304 response.
+    """
+    new_videos = []
+    new_etag = etag
+    page_token = None
+    while True:
+        request = youtube_api.playlistItems().list(
+            part="contentDetails",
+            maxResults=min(max_results, 50),
+            playlistId=uploads_playlist_id,
+            pageToken=page_token,
+        )
+        if page_token is None and etag is not None:
+            request.headers["If-None-Match"] = etag
+
+        try:
+            response = request.execute(http=apis.get_thread_http())
+        except HttpError as error:
+            if error.resp.status == 304:
+                return [], etag
+            raise
+
+        if page_token is None:
+            new_etag = response["etag"]
+
+        for item in response["items"]:
+            video_id = item["contentDetails"]["videoId"]
+            if video_id == last_video_id or len(new_videos) >= max_results:
+                return new_videos, new_etag
+            new_videos.append(
+                {"id": video_id, "date": item["contentDetails"].get("videoPublishedAt")}
+            )
+
+        page_token = response.get("nextPageToken")
+        if page_token is None or len(new_videos) >= max_results:
+            return new_videos, new_etag
 
 
 def get_videos_info(videos_ids: list[VideoID]) -> list[dict]:
-    response_items = []
-    for videos_ids_chunk in chunks(videos_ids):
-        request = youtube_api.videos().list(part="snippet,contentDetails", id=videos_ids_chunk)
-        chunk_response = request.execute()
-        response_items += chunk_response["items"]
+    response_items = list_in_chunks(list_videos, videos_ids)
 
     videos_info_list = []
     for item in response_items:
@@ -64,8 +128,13 @@ def get_videos_info(videos_ids: list[VideoID]) -> list[dict]:
     return videos_info_list
 
 
-def get_available_transcript(video_id: VideoID) -> Transcript | None:
-    try:
-        return yt_transcript_api.list_transcripts(video_id).find_transcript(["en"])
-    except apis.TranscriptError:
-        return None
+def get_available_transcript(video_id: VideoID) -> Transcript:
+    """Raises apis.TranscriptError if no english transcript is available."""
+    with transcripts_limiter.limit(TRANSCRIPTS_HOST):
+        transcripts_list = yt_transcript_api.list_transcripts(video_id)
+    return transcripts_list.find_transcript(["en"])
+
+
+def fetch_transcript(transcript: Transcript) -> list[dict]:
+    with transcripts_limiter.limit(TRANSCRIPTS_HOST):
+        return transcript.fetch()
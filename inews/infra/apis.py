@@ -1,6 +1,9 @@
 import os
+import threading
 
 import googleapiclient.discovery
+import googleapiclient.http
+import httplib2
 import mailchimp_marketing
 import openai
 from dotenv import load_dotenv
@@ -17,6 +20,8 @@ load_dotenv()
 
 MAILCHIMP_SERVER_PREFIX = "us21"
 
+_thread_local = threading.local()
+
 
 def get_youtube():
     api_key = os.environ["GOOGLE_API_KEY"]
@@ -26,12 +31,22 @@ def get_youtube():
     return youtube
 
 
+def get_thread_http() -> httplib2.Http:
+    # httplib2 connections are not thread-safe, each thread gets its own (with the client's
+    # default timeout, so that a stuck connection does not hang the run)
+    if not hasattr(_thread_local, "http"):
+        _thread_local.http = googleapiclient.http.build_http()
+    return _thread_local.http
+
+
 def get_yt_transcript():
     return YouTubeTranscriptApi
 
 
 def get_openai():
     openai.api_key = os.getenv("OPENAI_API_KEY")
+    # allows running against a local stand-in server (see inews.infra.fake_openai)
+    openai.api_base = os.getenv("OPENAI_API_BASE", openai.api_base)
     return openai
 
 
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from inews.infra import io
+
+
+class ResponseCache:
+    """Content-addressed cache of llm responses, stored as one json file per request on local disk
+    and optionally mirrored to a bucket. Least recently used files are evicted once the local
+    cache exceeds max_bytes."""
+
+    def __init__(self, local_path: Path, s3_path: str, max_bytes: int):
+        self.local_path = local_path
+        self.s3_path = s3_path
+        self.max_bytes = max_bytes
+        self.bucket_name = None
+        self.pull_from_bucket = False
+        self.push_to_bucket = False
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        self.lock = threading.Lock()
+
+    def configure_bucket(self, bucket_name: str, pull: bool, push: bool) -> None:
+        self.bucket_name = bucket_name
+        self.pull_from_bucket = pull
+        self.push_to_bucket = push
+
+    @staticmethod
+    def get_key(**request) -> str:
+        serialized = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get_file_path(self, key: str) -> Path:
+        return self.local_path / f"{key}.json"
+
+    def get(self, key: str) -> str | None:
+        file_path = self.get_file_path(key)
+        if not file_path.is_file() and self.pull_from_bucket:
+            self.local_path.mkdir(parents=True, exist_ok=True)
+            io.pull_file_from_bucket(self.bucket_name, self.s3_path + file_path.name, file_path)
+
+        try:
+            os.utime(file_path)
+            response = io.load_from_json_file(file_path)["response"]
+        except FileNotFoundError:
+            # missing, or evicted in between by another thread
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def set(self, key: str, response: str) -> None:
+        self.local_path.mkdir(parents=True, exist_ok=True)
+        file_path = self.get_file_path(key)
+        io.save_to_json_file({"key": key, "response": response}, file_path)
+        if self.push_to_bucket:
+            io.push_file_to_bucket(self.bucket_name, file_path, self.s3_path + file_path.name)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(path.stat().st_size for path in self.local_path.glob("*.json"))
+            else:
+                self.size += file_path.stat().st_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        files = sorted(self.local_path.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        for file_path in files:
+            if self.size <= self.max_bytes:
+                break
+            self.size -= file_path.stat().st_size
+            file_path.unlink(missing_ok=True)
+
+    def stats(self) -> str:
+        return f"LLM responses cache: {self.hits} hits, {self.misses} misses"
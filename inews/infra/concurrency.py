@@ -0,0 +1,242 @@
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def timed_call(func: Callable[[T], R], item: T) -> tuple[R, float]:
+    start = time.perf_counter()
+    result = func(item)
+    return result, time.perf_counter() - start
+
+
+def thread_map(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int
+) -> list[tuple[R, float]]:
+    """Apply func to every item using at most max_workers threads.
+    Results are returned in the same order as items, each paired with its latency in seconds.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+
+    max_workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(timed_call, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+class TaskGraph:
+    """Run tasks on a shared thread pool as soon as all of their dependencies are done, instead of
+    waiting for whole stages to complete. Each stage has its own concurrency limit. Tasks can be
+    added while the graph is running, e.g. to fan out again after a join point.
+
+    If a task fails, its dependents are skipped and the first error is raised by run once the
+    other tasks are done.
+    """
+
+    def __init__(self, stages_max_workers: dict[str, int]):
+        self.stages_max_workers = stages_max_workers
+        self.tasks = {}
+        self.results = {}
+        self.waiting_on = {}
+        self.dependents = defaultdict(list)
+        self.ready = defaultdict(deque)
+        self.running = defaultdict(int)
+        self.busy_time = defaultdict(float)
+        self.tasks_count = defaultdict(int)
+        self.errors = []
+        self.wall_time = 0
+        self.executor = None
+        self.condition = threading.Condition()
+
+    def add(self, name: str, func: Callable[[], R], stage: str, after: Iterable[str] = ()) -> str:
+        with self.condition:
+            self.tasks[name] = (func, stage)
+            self.tasks_count[stage] += 1
+            self.waiting_on[name] = {dep for dep in after if dep not in self.results}
+            for dep in self.waiting_on[name]:
+                self.dependents[dep].append(name)
+            if len(self.waiting_on[name]) == 0:
+                self.ready[stage].append(name)
+                self.dispatch()
+        return name
+
+    def dispatch(self) -> None:
+        if self.executor is None:
+            return
+        for stage, ready in self.ready.items():
+            while len(ready) > 0 and self.running[stage] < self.stages_max_workers[stage]:
+                name = ready.popleft()
+                self.running[stage] += 1
+                self.executor.submit(self.execute, name)
+
+    def execute(self, name: str) -> None:
+        func, stage = self.tasks[name]
+        start = time.perf_counter()
+        try:
+            result, error = func(), None
+        except Exception as e:
+            result, error = None, e
+        latency = time.perf_counter() - start
+
+        with self.condition:
+            self.running[stage] -= 1
+            self.busy_time[stage] += latency
+            if error is not None:
+                self.errors.append(error)
+                self.skip_dependents(name)
+            else:
+                self.results[name] = result
+                for dependent in self.dependents.pop(name, []):
+                    if dependent not in self.tasks:
+                        continue
+                    self.waiting_on[dependent].discard(name)
+                    if len(self.waiting_on[dependent]) == 0:
+                        self.ready[self.tasks[dependent][1]].append(dependent)
+            del self.tasks[name]
+            self.dispatch()
+            self.condition.notify_all()
+
+    def skip_dependents(self, name: str) -> None:
+        for dependent in self.dependents.pop(name, []):
+            if dependent in self.tasks:
+                del self.tasks[dependent]
+                self.skip_dependents(dependent)
+
+    def run(self) -> dict[str, R]:
+        """Run every task until the graph is exhausted, returns the results by task name."""
+        max_workers = max(1, sum(self.stages_max_workers.values()))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, self.condition:
+            self.executor = executor
+            self.dispatch()
+            while sum(self.running.values()) > 0 or any(self.ready.values()):
+                self.condition.wait()
+            self.executor = None
+        self.wall_time = time.perf_counter() - start
+
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        return self.results
+
+    def stats(self) -> str:
+        lines = [f"Pipeline tasks done in {self.wall_time:.2f}s:"]
+        for stage, count in self.tasks_count.items():
+            lines.append(f"    > {stage}: {count} tasks, {self.busy_time[stage]:.2f}s busy")
+        return "\n".join(lines)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens: float = 1) -> None:
+        while True:
+            with self.lock:
+                self.refill()
+                # a request larger than the bucket could never be served otherwise
+                tokens = min(tokens, self.capacity)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def calibrate(self, rate: float, capacity: float, tokens: float) -> None:
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.capacity = capacity
+            # tokens reserved by requests still in flight are not known to the provider yet
+            self.tokens = min(self.tokens, tokens)
+
+
+class RateLimiter:
+    """Token bucket shared by all requests, along with a cap on concurrent requests per host."""
+
+    def __init__(self, requests_per_second: float, burst: int, max_per_host: int):
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.max_per_host = max_per_host
+        self.hosts_semaphores = {}
+        self.lock = threading.Lock()
+
+    def host_semaphore(self, host: str) -> threading.Semaphore:
+        with self.lock:
+            if host not in self.hosts_semaphores:
+                self.hosts_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.hosts_semaphores[host]
+
+    @contextmanager
+    def limit(self, host: str):
+        with self.host_semaphore(host):
+            self.bucket.acquire()
+            yield
+
+
+def parse_duration(duration: str) -> float:
+    """Parse durations such as "1s", "6m0s" or "20ms" into seconds."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    matches = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", duration)
+    if len(matches) == 0:
+        return float(duration)
+    return sum(float(value) * units[unit] for value, unit in matches)
+
+
+class AdaptiveRateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets, modeled as two token buckets that are
+    recalibrated from the provider's rate limit headers after each response. Calls are delayed
+    just enough to stay under the limits instead of hitting them and backing off."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> None:
+        with self.lock:
+            pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
+
+    def update(self, headers: dict) -> None:
+        headers = {key.lower(): value for key, value in headers.items()}
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None or remaining is None:
+                continue
+            bucket.calibrate(float(limit) / 60, float(limit), float(remaining))
+
+        retry_after = get_retry_after(headers)
+        if retry_after is not None:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+def get_retry_after(headers: dict) -> float | None:
+    headers = {key.lower(): value for key, value in headers.items()}
+    if "retry-after-ms" in headers:
+        return float(headers["retry-after-ms"]) / 1000
+    if "retry-after" in headers:
+        return parse_duration(headers["retry-after"])
+    return None
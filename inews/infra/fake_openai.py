@@ -0,0 +1,356 @@
+"""Local stand-in for the OpenAI api, to run the pipeline offline.
+
+Start it with `python -m inews.infra.fake_openai` and point the pipeline at it with
+OPENAI_API_BASE=http://localhost:8000/v1
+
+Completions take a random time drawn from a lognormal distribution plus a delay proportional to
+the completion tokens, and fail with 429 or 500 errors at the given rates. Answers have the shape
+the pipeline expects (a yes/no per item for the selection, json for stories) so that whole runs
+can be benchmarked against it.
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+def get_id(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex[:24]}"
+
+
+def get_words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def create_content(body: dict, rng: random.Random, completion_tokens: int) -> str:
+    prompt = body["messages"][-1]["content"]
+    if "List of common topics:" in prompt:
+        topics = prompt.split("List of common topics:")[1]
+        items_count = len(re.findall(r"^\d+\. ", topics, flags=re.MULTILINE))
+        return ",".join(rng.choice(["Yes", "No"]) for _ in range(items_count))
+
+    if body.get("response_format", {}).get("type") == "json_object":
+        match = re.search(r"a list of (\d+)\s+strings", prompt)
+        user_stories_count = int(match.group(1)) if match is not None else 1
+        return json.dumps(
+            {
+                "short": get_words(rng, 40),
+                "title": get_words(rng, 8).capitalize(),
+                "user_stories": [
+                    get_words(rng, completion_tokens) for _ in range(user_stories_count)
+                ],
+            }
+        )
+
+    match = re.search(r"Write (\d+) words", prompt)
+    if match is not None:
+        return ", ".join(get_words(rng, 1).capitalize() for _ in range(int(match.group(1))))
+
+    words_count = max(1, round(rng.gauss(completion_tokens, completion_tokens / 4)))
+    return get_words(rng, words_count)
+
+
+def create_chat_completion(body: dict, rng: random.Random, completion_tokens: int) -> dict:
+    prompt_tokens = sum(len(message["content"].split()) for message in body["messages"])
+    content = create_content(body, rng, completion_tokens)
+    return {
+        "id": get_id("chatcmpl"),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content.split()),
+            "total_tokens": prompt_tokens + len(content.split()),
+        },
+    }
+
+
+class Behavior:
+    """Latency distribution, completion length and injected errors of the fake completions."""
+
+    def __init__(
+        self,
+        latency_median: float,
+        latency_sigma: float,
+        seconds_per_token: float,
+        completion_tokens: int,
+        error_rate_429: float,
+        error_rate_500: float,
+        seed: int | None,
+    ):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.seconds_per_token = seconds_per_token
+        self.completion_tokens = completion_tokens
+        self.error_rate_429 = error_rate_429
+        self.error_rate_500 = error_rate_500
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def get_latency(self, completion_tokens: int) -> float:
+        with self.lock:
+            latency = 0
+            if self.latency_median > 0:
+                latency = self.rng.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+        return latency + completion_tokens * self.seconds_per_token
+
+    def get_error(self) -> int | None:
+        with self.lock:
+            draw = self.rng.random()
+        if draw < self.error_rate_429:
+            return 429
+        if draw < self.error_rate_429 + self.error_rate_500:
+            return 500
+        return None
+
+    def create_chat_completion(self, body: dict) -> dict:
+        with self.lock:
+            rng = random.Random(self.rng.random())
+        return create_chat_completion(body, rng, self.completion_tokens)
+
+
+class RateLimits:
+    """Sliding one-minute window of requests and tokens, reported through the same headers as the
+    real api."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.window = []
+        self.lock = threading.Lock()
+
+    def consume(self, tokens: int) -> tuple[bool, dict]:
+        with self.lock:
+            now = time.monotonic()
+            self.window = [(at, used) for at, used in self.window if now - at < 60]
+            used = {"requests": len(self.window), "tokens": sum(used for _, used in self.window)}
+            allowed = (
+                used["requests"] + 1 <= self.limits["requests"]
+                and used["tokens"] + tokens <= self.limits["tokens"]
+            )
+            if allowed:
+                self.window.append((now, tokens))
+                used["requests"] += 1
+                used["tokens"] += tokens
+
+            reset = 60 - (now - self.window[0][0]) if len(self.window) > 0 else 0
+            headers = {}
+            for kind, limit in self.limits.items():
+                headers[f"x-ratelimit-limit-{kind}"] = str(limit)
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, limit - used[kind]))
+                headers[f"x-ratelimit-reset-{kind}"] = f"{reset:.3f}s"
+            if not allowed:
+                headers["retry-after-ms"] = str(int(reset * 1000))
+            return allowed, headers
+
+
+class FakeOpenAIState:
+    def __init__(self, batch_duration: float, rate_limits: RateLimits, behavior: Behavior):
+        self.batch_duration = batch_duration
+        self.rate_limits = rate_limits
+        self.behavior = behavior
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def create_file(self, content: bytes, purpose: str) -> dict:
+        file = {
+            "id": get_id("file"),
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": "upload.jsonl",
+            "purpose": purpose,
+        }
+        with self.lock:
+            self.files[file["id"]] = (file, content)
+        return file
+
+    def create_batch(self, body: dict) -> dict:
+        batch = {
+            "id": get_id("batch"),
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "output_file_id": None,
+            "created_at": int(time.time()),
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        return batch
+
+    def get_batch(self, batch_id: str) -> dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+            in_progress = batch["status"] == "in_progress"
+        if in_progress and time.time() - batch["created_at"] >= self.batch_duration:
+            self.complete_batch(batch)
+        return batch
+
+    def complete_batch(self, batch: dict) -> None:
+        _, content = self.files[batch["input_file_id"]]
+        output_lines = []
+        for line in content.decode("utf-8").splitlines():
+            request = json.loads(line)
+            output_lines.append(
+                json.dumps(
+                    {
+                        "id": get_id("batch_req"),
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "request_id": get_id("req"),
+                            "body": self.behavior.create_chat_completion(request["body"]),
+                        },
+                        "error": None,
+                    }
+                )
+            )
+        output_file = self.create_file("\n".join(output_lines).encode("utf-8"), "batch_output")
+        with self.lock:
+            batch["status"] = "completed"
+            batch["output_file_id"] = output_file["id"]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    state: FakeOpenAIState
+
+    def send_json(self, data: dict, status: int = 200, headers: dict | None = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chat_completion(self) -> None:
+        behavior = self.state.behavior
+        completion = behavior.create_chat_completion(json.loads(self.read_body()))
+        allowed, headers = self.state.rate_limits.consume(completion["usage"]["total_tokens"])
+        if not allowed:
+            error = {"message": "Rate limit reached", "type": "requests", "code": "rate_limit"}
+            self.send_json({"error": error}, status=429, headers=headers)
+            return
+
+        injected_error = behavior.get_error()
+        if injected_error == 429:
+            headers["retry-after-ms"] = str(behavior.rng.randint(100, 1000))
+            error = {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit"}
+            self.send_json({"error": error}, status=429, headers=headers)
+            return
+        if injected_error == 500:
+            error = {"message": "The server had an error while processing your request"}
+            self.send_json({"error": {**error, "type": "server_error"}}, status=500)
+            return
+
+        time.sleep(behavior.get_latency(completion["usage"]["completion_tokens"]))
+        self.send_json(completion, headers=headers)
+
+    def send_not_found(self) -> None:
+        self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def read_multipart(self) -> dict[str, bytes]:
+        content_type = self.headers["Content-Type"]
+        message = BytesParser(policy=default_policy).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + self.read_body()
+        )
+        return {
+            part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+            for part in message.iter_parts()
+        }
+
+    def do_POST(self):  # noqa: N802
+        if self.path == "/v1/chat/completions":
+            self.send_chat_completion()
+        elif self.path == "/v1/files":
+            fields = self.read_multipart()
+            self.send_json(self.state.create_file(fields["file"], fields["purpose"].decode()))
+        elif self.path == "/v1/batches":
+            self.send_json(self.state.create_batch(json.loads(self.read_body())))
+        else:
+            self.send_not_found()
+
+    def do_GET(self):  # noqa: N802
+        parts = self.path.strip("/").split("/")
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            self.send_json(self.state.get_batch(parts[2]))
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+            _, content = self.state.files[parts[2]]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_not_found()
+
+
+def serve(
+    host: str, port: int, batch_duration: float, rate_limits: RateLimits, behavior: Behavior
+) -> None:
+    FakeOpenAIHandler.state = FakeOpenAIState(batch_duration, rate_limits, behavior)
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    print(f"Fake OpenAI api listening on http://{host}:{port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Fake OpenAI api")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--batch-duration", type=float, default=0, help="seconds before a batch completes"
+    )
+    parser.add_argument("--rpm", type=int, default=3500, help="requests per minute limit")
+    parser.add_argument("--tpm", type=int, default=60000, help="tokens per minute limit")
+    parser.add_argument(
+        "--latency-median", type=float, default=0.5, help="median seconds before answering"
+    )
+    parser.add_argument(
+        "--latency-sigma", type=float, default=0.5, help="spread of the lognormal latency"
+    )
+    parser.add_argument(
+        "--seconds-per-token", type=float, default=0.01, help="added latency per completion token"
+    )
+    parser.add_argument(
+        "--completion-tokens", type=int, default=200, help="mean length of free text answers"
+    )
+    parser.add_argument("--error-rate-429", type=float, default=0, help="injected 429 errors")
+    parser.add_argument("--error-rate-500", type=float, default=0, help="injected 500 errors")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    behavior = Behavior(
+        args.latency_median,
+        args.latency_sigma,
+        args.seconds_per_token,
+        args.completion_tokens,
+        args.error_rate_429,
+        args.error_rate_500,
+        args.seed,
+    )
+    serve(args.host, args.port, args.batch_duration, RateLimits(args.rpm, args.tpm), behavior)
@@ -1,13 +1,22 @@
+import functools
+import gzip
+import hashlib
 import json
 import os
+import threading
 from pathlib import Path
 from typing import Any
 
 import boto3
+import orjson
+import pendulum
 import yaml
+import zstandard
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
+from inews.infra import concurrency, store
 from inews.infra.types import ChannelID, VideoID, VideoInfoP
 
 load_dotenv()
@@ -22,12 +31,25 @@ s3 = boto3.resource(
 )
 
 
+# multipart uploads above 8MB, the ETags of uploaded files are computed with the same parts size
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024**2, multipart_chunksize=8 * 1024**2)
+
+
 # S3
 CHANNELS_S3_FILE = "channels_state.json"
 VIDEOS_S3_FILE = "videos_state.json"
+VIDEOS_CHANGES_S3_FILE = "videos_state.changes.jsonl"
+TRANSCRIPTS_MISSES_S3_FILE = "transcripts_misses.json"
+LLM_BATCHES_S3_FILE = "llm_batches.json"
+LLM_LEDGER_S3_FILE = "llm_ledger.jsonl"
+RUN_JOURNAL_S3_FILE = "run_journal.json"
+STORE_S3_FILE = "inews.sqlite3"
+TRANSCRIPTS_S3_PATH = "transcripts/"
+SUMMARIES_S3_PATH = "summaries/"
 STORIES_S3_PATH = "stories/"
 NEWSLETTERS_S3_PATH = "newsletters/"
 ISSUES_S3_PATH = "issues/"
+LLM_CACHE_S3_PATH = "llm_cache/"
 
 # Config
 CHANNELS_ID_FILE = Path("config/channels_id.yaml")
@@ -38,39 +60,86 @@ MAILING_CONFIG_FILE = Path("config/mailing.yaml")
 DATA_PATH = Path("/tmp") if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else Path("data")
 CHANNELS_LOCAL_FILE = DATA_PATH / Path("channels_state.json")
 VIDEOS_LOCAL_FILE = DATA_PATH / Path("videos_state.json")
+VIDEOS_CHANGES_LOCAL_FILE = DATA_PATH / Path("videos_state.changes.jsonl")
+TRANSCRIPTS_MISSES_LOCAL_FILE = DATA_PATH / Path("transcripts_misses.json")
+LLM_BATCHES_LOCAL_FILE = DATA_PATH / Path("llm_batches.json")
+LLM_LEDGER_LOCAL_FILE = DATA_PATH / Path("llm_ledger.jsonl")
+RUN_JOURNAL_LOCAL_FILE = DATA_PATH / Path("run_journal.json")
+STORE_LOCAL_FILE = DATA_PATH / Path("inews.sqlite3")
+S3_SYNC_MANIFEST_LOCAL_FILE = DATA_PATH / Path("s3_sync_manifest.json")
 TRANSCRIPTS_LOCAL_PATH = DATA_PATH / Path("transcripts/")
 SUMMARIES_LOCAL_PATH = DATA_PATH / Path("summaries/")
 STORIES_LOCAL_PATH = DATA_PATH / Path("stories/")
 NEWSLETTERS_LOCAL_PATH = DATA_PATH / Path("newsletters/")
+LLM_CACHE_LOCAL_PATH = DATA_PATH / Path("llm_cache/")
 
 # Html
 HTML_TEMPLATE_PATH = Path("inews/templates/")
 HTML_BUILD_PATH = DATA_PATH / Path("html/")
 
+# Artifacts
+STATES_LOCAL_FILES = {"channels": CHANNELS_LOCAL_FILE, "videos": VIDEOS_LOCAL_FILE}
+STATES_CHANGES_LOCAL_FILES = {"videos": VIDEOS_CHANGES_LOCAL_FILE}
+ARTIFACTS_LOCAL_PATHS = {
+    "transcripts": TRANSCRIPTS_LOCAL_PATH,
+    "summaries": SUMMARIES_LOCAL_PATH,
+    "stories": STORIES_LOCAL_PATH,
+}
+ARTIFACTS_S3_PATHS = {
+    "transcripts": TRANSCRIPTS_S3_PATH,
+    "summaries": SUMMARIES_S3_PATH,
+    "stories": STORIES_S3_PATH,
+}
+JSON_EXTENSIONS = (".json", ".json.gz", ".json.zst")
+# stamped on the states items written by the pipeline, to be increased whenever their models
+# change, items stamped with another version are fully validated when loaded
+SCHEMA_VERSION = 1
+PARTITIONED_ARTIFACTS = ("stories",)
+ARTIFACTS_VIDEO_INFO_KEYS = {
+    "transcripts": "info",
+    "summaries": "video_info",
+    "stories": "video_info",
+}
 
-def clear_bucket(bucket_name: str) -> None:
-    bucket = s3.Bucket(bucket_name)
-    to_delete = []
-    for object in bucket.objects.all():
-        if object.key.endswith("json"):
-            to_delete.append({"Key": object.key})
 
-    bucket.delete_objects(Delete={"Objects": to_delete})
+def clear_bucket(bucket_name: str) -> None:
+    to_delete = [
+        {"Key": s3_object["Key"]}
+        for s3_object in list_bucket_objects(bucket_name)
+        if s3_object["Key"].endswith((*JSON_EXTENSIONS, ".sqlite3"))
+        or s3_object["Key"] == VIDEOS_CHANGES_S3_FILE
+    ]
+    # delete requests are limited to 1000 keys
+    for idx in range(0, len(to_delete), 1000):
+        s3.meta.client.delete_objects(
+            Bucket=bucket_name, Delete={"Objects": to_delete[idx : idx + 1000]}
+        )
+    print(f"Deleted {len(to_delete)} files from {bucket_name} bucket")
 
 
 def clear_local() -> None:
-    for json_file_path in DATA_PATH.rglob("*.json"):
-        json_file_path.unlink()
+    for json_file_path in DATA_PATH.rglob("*.json*"):
+        if json_file_path.name.endswith(JSON_EXTENSIONS):
+            json_file_path.unlink()
+    # the states changes logs would otherwise be replayed on an empty state
+    for changes_file_path in STATES_CHANGES_LOCAL_FILES.values():
+        changes_file_path.unlink(missing_ok=True)
 
     for html_file_path in HTML_BUILD_PATH.rglob("*.html"):
         html_file_path.unlink()
 
+    if get_store() is not None:
+        get_store().close()
+    STORE_LOCAL_FILE.unlink(missing_ok=True)
+    manifest.reset()
+
 
 def make_data_dirs():
     TRANSCRIPTS_LOCAL_PATH.mkdir(parents=True, exist_ok=True)
     SUMMARIES_LOCAL_PATH.mkdir(parents=True, exist_ok=True)
     STORIES_LOCAL_PATH.mkdir(parents=True, exist_ok=True)
     NEWSLETTERS_LOCAL_PATH.mkdir(parents=True, exist_ok=True)
+    LLM_CACHE_LOCAL_PATH.mkdir(parents=True, exist_ok=True)
     HTML_BUILD_PATH.mkdir(parents=True, exist_ok=True)
 
 
@@ -82,45 +151,206 @@ def download_file_from_bucket(bucket, s3_path: str, local_path: Path) -> None:
         return 0
 
 
-def pull_data_from_bucket(bucket_name: str) -> None:
-    files_count = 0
-    bucket = s3.Bucket(bucket_name)
-    files_count += download_file_from_bucket(bucket, CHANNELS_S3_FILE, CHANNELS_LOCAL_FILE)
-    files_count += download_file_from_bucket(bucket, VIDEOS_S3_FILE, VIDEOS_LOCAL_FILE)
+def pull_file_from_bucket(bucket_name: str, s3_path: str, local_path: Path) -> int:
+    # through the shared client, these are called from the pipeline threads
+    try:
+        s3.meta.client.download_file(bucket_name, s3_path, str(local_path))
+        return 1
+    except ClientError:
+        return 0
 
-    for object in bucket.objects.filter(Prefix=STORIES_S3_PATH):
-        if object.key.endswith("json"):
-            local_file_name = Path(object.key).name
-            local_file_path = STORIES_LOCAL_PATH / local_file_name
-            files_count += download_file_from_bucket(bucket, object.key, local_file_path)
 
-    print(f"Downloaded {files_count} data files from {bucket_name} bucket")
+def push_file_to_bucket(bucket_name: str, local_path: Path, s3_path: str) -> None:
+    upload_file(bucket_name, (local_path, s3_path))
+
+
+def list_bucket_objects(
+    bucket_name: str, prefix: str = "", delimiter: str = "", start_after: str = ""
+) -> list[dict]:
+    paginator = s3.meta.client.get_paginator("list_objects_v2")
+    objects = []
+    pages = paginator.paginate(
+        Bucket=bucket_name, Prefix=prefix, Delimiter=delimiter, StartAfter=start_after
+    )
+    for page in pages:
+        objects += page.get("Contents", [])
+    return objects
+
+
+def load_sync_manifest() -> dict:
+    if not S3_SYNC_MANIFEST_LOCAL_FILE.is_file():
+        return {}
+    return load_from_json_file(S3_SYNC_MANIFEST_LOCAL_FILE)
+
+
+def is_synced(s3_object: dict, local_path: Path, synced: dict | None) -> bool:
+    """Whether the local file is still the copy of the object that was last downloaded."""
+    if synced is None or not local_path.is_file():
+        return False
+    return (
+        synced["etag"] == s3_object["ETag"]
+        and synced["last_modified"] == s3_object["LastModified"].isoformat()
+        and synced["local_mtime"] == local_path.stat().st_mtime_ns
+    )
+
+
+def download_object(bucket_name: str, transfer: tuple[dict, Path]) -> None:
+    # the client is thread safe and shared, unlike the resource objects
+    s3_object, local_path = transfer
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    s3.meta.client.download_file(bucket_name, s3_object["Key"], str(local_path))
+
+
+def pull_data_from_bucket(bucket_name: str, dry_run: bool = False) -> None:
+    """Download the data files that changed in the bucket since the last pull, concurrently.
+    With dry_run, only report what would be downloaded."""
+    root_files = {
+        TRANSCRIPTS_MISSES_S3_FILE: TRANSCRIPTS_MISSES_LOCAL_FILE,
+        LLM_BATCHES_S3_FILE: LLM_BATCHES_LOCAL_FILE,
+        LLM_LEDGER_S3_FILE: LLM_LEDGER_LOCAL_FILE,
+        RUN_JOURNAL_S3_FILE: RUN_JOURNAL_LOCAL_FILE,
+    }
+    if get_store() is not None:
+        root_files[STORE_S3_FILE] = STORE_LOCAL_FILE
+    else:
+        root_files[CHANNELS_S3_FILE] = CHANNELS_LOCAL_FILE
+        root_files[VIDEOS_S3_FILE] = VIDEOS_LOCAL_FILE
+        root_files[VIDEOS_CHANGES_S3_FILE] = VIDEOS_CHANGES_LOCAL_FILE
+
+    transfers = [
+        (s3_object, root_files[s3_object["Key"]])
+        for s3_object in list_bucket_objects(bucket_name, delimiter="/")
+        if s3_object["Key"] in root_files
+    ]
+    # with the read-through cache, stories are downloaded when they are read
+    if get_store() is None and not read_through.enabled:
+        # only the partitions of stories that can still be used, by the pipeline or a newsletter
+        data_config = get_data_config()
+        days_old = max(
+            data_config["newsletter_stories_days_old"], data_config["recent_videos_days_old"]
+        )
+        since = pendulum.now("UTC").subtract(days=days_old)
+        for partition in get_partitions_since("stories", since):
+            transfers += [
+                (s3_object, STORIES_LOCAL_PATH / s3_object["Key"][len(STORIES_S3_PATH) :])
+                for s3_object in list_bucket_objects(
+                    bucket_name, prefix=get_artifacts_s3_path("stories", partition)
+                )
+                if s3_object["Key"].endswith(JSON_EXTENSIONS)
+            ]
+
+    sync_manifest = load_sync_manifest()
+    changed = [
+        (s3_object, local_path)
+        for s3_object, local_path in transfers
+        if not is_synced(s3_object, local_path, sync_manifest.get(s3_object["Key"]))
+    ]
+    changed_bytes = sum(s3_object["Size"] for s3_object, _ in changed)
+    if dry_run:
+        print(f"Dry run: {len(changed)} of {len(transfers)} files to download from {bucket_name}")
+        print(f"    > {changed_bytes} bytes")
+        for s3_object, _ in changed:
+            print(f"    > {s3_object['Key']} ({s3_object['Size']} bytes)")
+        return
+
+    if get_store() is not None:
+        get_store().close()
+
+    concurrency.thread_map(
+        functools.partial(download_object, bucket_name),
+        changed,
+        get_data_config()["s3_max_workers"],
+    )
+    for s3_object, local_path in changed:
+        sync_manifest[s3_object["Key"]] = {
+            "etag": s3_object["ETag"],
+            "last_modified": s3_object["LastModified"].isoformat(),
+            "local_mtime": local_path.stat().st_mtime_ns,
+        }
+    save_to_json_file(sync_manifest, S3_SYNC_MANIFEST_LOCAL_FILE)
+    manifest.reset()
+
+    print(f"Downloaded {len(changed)} data files from {bucket_name} bucket ({changed_bytes} bytes)")
+    print(f"    > {len(transfers) - len(changed)} files unchanged")
+
+
+def get_etag(file_path: Path) -> str:
+    """The ETag S3 gives to the file once uploaded with TRANSFER_CONFIG: the md5 of its content,
+    or the md5 of the parts md5 followed by the parts count for multipart uploads."""
+    parts_md5 = []
+    with open(file_path, "rb") as file:
+        while chunk := file.read(TRANSFER_CONFIG.multipart_chunksize):
+            parts_md5.append(hashlib.md5(chunk))
+    if file_path.stat().st_size < TRANSFER_CONFIG.multipart_threshold:
+        md5 = parts_md5[0].hexdigest() if len(parts_md5) > 0 else hashlib.md5().hexdigest()
+        return f'"{md5}"'
+    md5 = hashlib.md5(b"".join(part_md5.digest() for part_md5 in parts_md5)).hexdigest()
+    return f'"{md5}-{len(parts_md5)}"'
+
+
+def upload_file(bucket_name: str, transfer: tuple[Path, str]) -> None:
+    local_path, s3_path = transfer
+    s3.meta.client.upload_file(str(local_path), bucket_name, s3_path, Config=TRANSFER_CONFIG)
+
+
+def push_files_to_bucket(bucket_name: str, transfers: list[tuple[Path, str]], label: str) -> None:
+    """Upload concurrently the local files whose content differs from their copy in the bucket."""
+    remote_etags = {}
+    for prefix in {s3_path[: s3_path.rfind("/") + 1] for _, s3_path in transfers}:
+        for s3_object in list_bucket_objects(bucket_name, prefix=prefix, delimiter="/"):
+            remote_etags[s3_object["Key"]] = s3_object["ETag"]
+
+    changed = []
+    unchanged_bytes = 0
+    for local_path, s3_path in transfers:
+        if get_etag(local_path) == remote_etags.get(s3_path):
+            unchanged_bytes += local_path.stat().st_size
+        else:
+            changed.append((local_path, s3_path))
+    changed_bytes = sum(local_path.stat().st_size for local_path, _ in changed)
+
+    concurrency.thread_map(
+        functools.partial(upload_file, bucket_name),
+        changed,
+        get_data_config()["s3_max_workers"],
+    )
+    print(f"Uploaded {len(changed)} {label} files to {bucket_name} bucket ({changed_bytes} bytes)")
+    print(f"    > {len(transfers) - len(changed)} files unchanged ({unchanged_bytes} bytes)")
 
 
 def push_data_to_bucket(bucket_name: str) -> None:
-    bucket = s3.Bucket(bucket_name)
-    bucket.upload_file(CHANNELS_LOCAL_FILE, CHANNELS_S3_FILE)
-    bucket.upload_file(VIDEOS_LOCAL_FILE, VIDEOS_S3_FILE)
-
-    files_count = 2
-    for story_file_path in STORIES_LOCAL_PATH.rglob("*.json"):
-        s3_file_path = STORIES_S3_PATH + story_file_path.name
-        bucket.upload_file(story_file_path, s3_file_path)
-        files_count += 1
-
-    print(f"Uploaded {files_count} data files to {bucket_name} bucket")
+    transfers = [(TRANSCRIPTS_MISSES_LOCAL_FILE, TRANSCRIPTS_MISSES_S3_FILE)]
+    if LLM_BATCHES_LOCAL_FILE.is_file():
+        transfers.append((LLM_BATCHES_LOCAL_FILE, LLM_BATCHES_S3_FILE))
+    if LLM_LEDGER_LOCAL_FILE.is_file():
+        transfers.append((LLM_LEDGER_LOCAL_FILE, LLM_LEDGER_S3_FILE))
+    if RUN_JOURNAL_LOCAL_FILE.is_file():
+        transfers.append((RUN_JOURNAL_LOCAL_FILE, RUN_JOURNAL_S3_FILE))
+
+    if get_store() is not None:
+        transfers.append((STORE_LOCAL_FILE, STORE_S3_FILE))
+    else:
+        transfers.append((CHANNELS_LOCAL_FILE, CHANNELS_S3_FILE))
+        transfers.append((VIDEOS_LOCAL_FILE, VIDEOS_S3_FILE))
+        if VIDEOS_CHANGES_LOCAL_FILE.is_file():
+            transfers.append((VIDEOS_CHANGES_LOCAL_FILE, VIDEOS_CHANGES_S3_FILE))
+    # with the read-through cache, artifacts are uploaded as they are saved
+    if get_store() is None and not read_through.enabled:
+        for story_file_path in manifest.get_files("stories").values():
+            story_s3_path = (
+                STORIES_S3_PATH + story_file_path.relative_to(STORIES_LOCAL_PATH).as_posix()
+            )
+            transfers.append((story_file_path, story_s3_path))
+
+    push_files_to_bucket(bucket_name, transfers, "data")
 
 
 def push_newsletters_to_bucket(bucket_name: str) -> None:
-    bucket = s3.Bucket(bucket_name)
-    files_count = 0
-
-    for newsletter_file_path in NEWSLETTERS_LOCAL_PATH.rglob("*.json"):
-        s3_file_path = NEWSLETTERS_S3_PATH + newsletter_file_path.name
-        bucket.upload_file(newsletter_file_path, s3_file_path)
-        files_count += 1
-
-    print(f"Uploaded {files_count} newsletter files to {bucket_name} bucket")
+    transfers = [
+        (newsletter_file_path, NEWSLETTERS_S3_PATH + newsletter_file_path.name)
+        for newsletter_file_path in NEWSLETTERS_LOCAL_PATH.rglob("*.json")
+    ]
+    push_files_to_bucket(bucket_name, transfers, "newsletter")
 
 
 def pull_issues_from_bucket(bucket_name: str) -> None:
@@ -134,11 +364,11 @@ def pull_issues_from_bucket(bucket_name: str) -> None:
 
 
 def push_issues_to_bucket(bucket_name: str) -> None:
-    bucket = s3.Bucket(bucket_name)
-
-    for issue_file_path in HTML_BUILD_PATH.rglob("*.html"):
-        s3_file_path = ISSUES_S3_PATH + issue_file_path.name
-        bucket.upload_file(issue_file_path, s3_file_path)
+    transfers = [
+        (issue_file_path, ISSUES_S3_PATH + issue_file_path.name)
+        for issue_file_path in HTML_BUILD_PATH.rglob("*.html")
+    ]
+    push_files_to_bucket(bucket_name, transfers, "issue")
 
 
 def get_data_config() -> dict:
@@ -163,37 +393,594 @@ def get_file_name(video_info: VideoInfoP) -> Path:
     return Path(f"{video_info.date.date()}.{video_info.id}.json")
 
 
-def video_id_local_file(video_id: VideoID) -> Path | None:
-    local_path = None
-    for path in TRANSCRIPTS_LOCAL_PATH.rglob("*.json"):
-        if video_id in path.name:
-            local_path = path
-    return local_path
-
-
-def video_in_local_files(video_info: VideoInfoP) -> bool:
-    file_path = TRANSCRIPTS_LOCAL_PATH / get_file_name(video_info)
-    return file_path.is_file()
+def get_partition(kind: str, date: pendulum.Date) -> str:
+    """Partitioned artifacts are stored in one folder per iso week of the video date, e.g.
+    "2024-W07", so that reading the recent ones doesn't list the whole archive."""
+    if kind not in PARTITIONED_ARTIFACTS:
+        return ""
+    year, week, _ = date.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def get_partitions_since(kind: str, since: pendulum.DateTime) -> list[str]:
+    # with a day of margin on both ends, video dates are not in utc
+    date = since.in_tz("UTC").subtract(days=1).date()
+    end_date = pendulum.now("UTC").add(days=1).date()
+    partitions = []
+    while date <= end_date:
+        partition = get_partition(kind, date)
+        if partition not in partitions:
+            partitions.append(partition)
+        date = date.add(days=1)
+    return partitions
+
+
+def get_artifacts_s3_path(kind: str, partition: str) -> str:
+    return ARTIFACTS_S3_PATHS[kind] + (f"{partition}/" if partition else "")
+
+
+class ArtifactsManifest:
+    """Json artifacts files by kind, partition and video id. Each folder is listed once, on first
+    use, and kept up to date as artifacts are saved, so that lookups don't touch the filesystem."""
+
+    def __init__(self, local_paths: dict[str, Path]):
+        self.local_paths = local_paths
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def get_folder(self, kind: str, partition: str) -> dict[VideoID, Path]:
+        # called with the lock held, each folder is listed on first use only
+        if (kind, partition) not in self.files:
+            files = {}
+            folder_path = self.local_paths[kind] / partition
+            if folder_path.is_dir():
+                # file names are "{date}.{video_id}.json", possibly with a compression extension
+                for entry in os.scandir(folder_path):
+                    if entry.name.endswith(JSON_EXTENSIONS):
+                        files[entry.name.split(".")[1]] = Path(entry.path)
+            self.files[(kind, partition)] = files
+        return self.files[(kind, partition)]
+
+    def get_partition(self, kind: str, file_path: Path) -> str:
+        return "" if file_path.parent == self.local_paths[kind] else file_path.parent.name
+
+    def get_files(self, kind: str, partitions: list[str] | None = None) -> dict[VideoID, Path]:
+        """Files of the given partitions, or of every partition found locally."""
+        if partitions is None:
+            partitions = [""]
+            if kind in PARTITIONED_ARTIFACTS and self.local_paths[kind].is_dir():
+                partitions = [
+                    entry.name for entry in os.scandir(self.local_paths[kind]) if entry.is_dir()
+                ]
+        files = {}
+        with self.lock:
+            for partition in partitions:
+                files.update(self.get_folder(kind, partition))
+        return files
+
+    def get(self, kind: str, video_id: VideoID, partition: str = "") -> Path | None:
+        with self.lock:
+            return self.get_folder(kind, partition).get(video_id)
+
+    def add(self, kind: str, video_id: VideoID, file_path: Path) -> None:
+        with self.lock:
+            self.get_folder(kind, self.get_partition(kind, file_path))[video_id] = file_path
+
+    def remove(self, kind: str, video_id: VideoID, file_path: Path) -> None:
+        with self.lock:
+            self.get_folder(kind, self.get_partition(kind, file_path)).pop(video_id, None)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.files = {}
+
+
+manifest = ArtifactsManifest(ARTIFACTS_LOCAL_PATHS)
+
+
+class ArtifactsReadThrough:
+    """Json artifacts downloaded from the bucket on a local miss, so that a run only fetches what
+    it reads. The bucket is listed once per kind and video date, artifacts are uploaded as they
+    are saved, and the local copies that are in the bucket are evicted, least recently used first,
+    once they exceed max_bytes."""
+
+    def __init__(self, local_paths: dict[str, Path], s3_paths: dict[str, str]):
+        self.local_paths = local_paths
+        self.s3_paths = s3_paths
+        self.bucket_name = None
+        self.push_to_bucket = False
+        self.max_bytes = None
+        self.remote_keys = {}
+        self.in_bucket = set()
+        self.previous_files_listed = False
+        self.downloads = 0
+        self.evictions = 0
+        self.size = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.bucket_name is not None
+
+    def configure_bucket(self, bucket_name: str, push: bool, max_bytes: int) -> None:
+        self.bucket_name = bucket_name
+        self.push_to_bucket = push
+        self.max_bytes = max_bytes
+        self.remote_keys = {}
+        self.in_bucket = set()
+        self.previous_files_listed = False
+        self.size = None
+
+    def get_remote_keys(self, kind: str, date: pendulum.Date) -> dict[VideoID, str]:
+        with self.lock:
+            if (kind, str(date)) in self.remote_keys:
+                return self.remote_keys[(kind, str(date))]
+        remote_keys = {}
+        # keys are "{kind}/{partition}/{date}.{video_id}.json", possibly without partition and
+        # with a compression extension
+        prefix = get_artifacts_s3_path(kind, get_partition(kind, date))
+        for s3_object in list_bucket_objects(self.bucket_name, prefix=f"{prefix}{date}."):
+            file_name = Path(s3_object["Key"]).name
+            if file_name.endswith(JSON_EXTENSIONS):
+                remote_keys[file_name.split(".")[1]] = s3_object["Key"]
+        with self.lock:
+            self.in_bucket.update((kind, video_id) for video_id in remote_keys)
+            return self.remote_keys.setdefault((kind, str(date)), remote_keys)
+
+    def contains(self, kind: str, video_info: VideoInfoP) -> bool:
+        return video_info.id in self.get_remote_keys(kind, video_info.date.date())
+
+    def download(self, kind: str, video_id: VideoID, s3_path: str) -> Any:
+        # loaded from the downloaded content, the local copy may be evicted by another thread
+        content = s3.meta.client.get_object(Bucket=self.bucket_name, Key=s3_path)["Body"].read()
+        file_path = self.local_paths[kind] / s3_path[len(self.s3_paths[kind]) :]
+        file_path.parent.mkdir(exist_ok=True)
+        with open(file_path, "wb") as file:
+            file.write(content)
+        manifest.add(kind, video_id, file_path)
+        with self.lock:
+            self.in_bucket.add((kind, video_id))
+            self.downloads += 1
+        self.track(file_path)
+        return load_from_json_content(content, file_path.name)
+
+    def load_local(self, kind: str, video_id: VideoID, partition: str) -> Any | None:
+        file_path = manifest.get(kind, video_id, partition)
+        if file_path is None:
+            return None
+        try:
+            os.utime(file_path)
+            return load_from_json_file(file_path)
+        except FileNotFoundError:
+            # evicted in between
+            return None
+
+    def load(self, kind: str, video_info: VideoInfoP) -> Any:
+        date = video_info.date.date()
+        data = self.load_local(kind, video_info.id, get_partition(kind, date))
+        if data is not None:
+            return data
+        s3_path = self.get_remote_keys(kind, date).get(video_info.id)
+        if s3_path is None:
+            raise FileNotFoundError(f"No {kind} artifact for video {video_info.id}")
+        return self.download(kind, video_info.id, s3_path)
+
+    def load_file(self, kind: str, item: tuple[VideoID, str, str]) -> Any:
+        video_id, partition, file_name = item
+        data = self.load_local(kind, video_id, partition)
+        if data is not None:
+            return data
+        return self.download(kind, video_id, get_artifacts_s3_path(kind, partition) + file_name)
+
+    def load_since(self, kind: str, since: pendulum.DateTime | None) -> list[Any]:
+        """Artifacts of videos published since a date, the missing local copies are downloaded."""
+        since_date = since.in_tz("UTC").to_date_string() if since is not None else ""
+        partitions = get_partitions_since(kind, since) if since is not None else None
+        prefixes = [self.s3_paths[kind]]
+        if partitions is not None:
+            prefixes = [get_artifacts_s3_path(kind, partition) for partition in partitions]
+
+        files = {}
+        for prefix in prefixes:
+            # keys are sorted by name, which starts with the video date within a partition
+            for s3_object in list_bucket_objects(
+                self.bucket_name, prefix=prefix, start_after=prefix + since_date
+            ):
+                partition, _, file_name = s3_object["Key"][len(self.s3_paths[kind]) :].rpartition(
+                    "/"
+                )
+                if file_name.endswith(JSON_EXTENSIONS) and file_name[:10] >= since_date:
+                    files[file_name.split(".")[1]] = (partition, file_name)
+        with self.lock:
+            self.in_bucket.update((kind, video_id) for video_id in files)
+        for video_id, file_path in manifest.get_files(kind, partitions).items():
+            if file_path.name[:10] >= since_date:
+                files[video_id] = (manifest.get_partition(kind, file_path), file_path.name)
+
+        results = concurrency.thread_map(
+            functools.partial(self.load_file, kind),
+            sorted(((video_id, *file) for video_id, file in files.items()), key=lambda x: x[2]),
+            get_data_config()["s3_max_workers"],
+        )
+        return [data for data, _ in results]
+
+    def store(self, kind: str, video_id: VideoID, file_path: Path) -> None:
+        if self.push_to_bucket:
+            s3_path = self.s3_paths[kind] + file_path.relative_to(self.local_paths[kind]).as_posix()
+            upload_file(self.bucket_name, (file_path, s3_path))
+            with self.lock:
+                self.in_bucket.add((kind, video_id))
+                # the date is only listed on first use, later uploads are added to the listing
+                remote_keys = self.remote_keys.get((kind, file_path.name[:10]))
+                if remote_keys is not None:
+                    remote_keys[video_id] = s3_path
+        self.track(file_path)
+
+    def track(self, file_path: Path) -> None:
+        with self.lock:
+            if self.size is None:
+                self.size = sum(
+                    local_file_path.stat().st_size
+                    for kind in self.local_paths
+                    for local_file_path in manifest.get_files(kind).values()
+                )
+            else:
+                self.size += file_path.stat().st_size
+            if self.size > self.max_bytes:
+                self.evict(keep=file_path)
+
+    def list_previous_files(self) -> None:
+        """Local copies left by earlier runs (e.g. in a warm Lambda's /tmp) are not listed by this
+        one, those whose file is in the bucket with the same size become evictable too."""
+        for kind, local_path in self.local_paths.items():
+            local_files = manifest.get_files(kind)
+            if len(local_files) == 0:
+                continue
+            remote_sizes = {
+                s3_object["Key"]: s3_object["Size"]
+                for s3_object in list_bucket_objects(self.bucket_name, prefix=self.s3_paths[kind])
+            }
+            for video_id, file_path in local_files.items():
+                s3_path = self.s3_paths[kind] + file_path.relative_to(local_path).as_posix()
+                if remote_sizes.get(s3_path) == file_path.stat().st_size:
+                    self.in_bucket.add((kind, video_id))
+        self.previous_files_listed = True
+
+    def evict(self, keep: Path) -> None:
+        # called with the lock held, local copies that are not in the bucket are never evicted
+        if not self.previous_files_listed:
+            self.list_previous_files()
+        files = []
+        self.size = 0
+        for kind in self.local_paths:
+            for video_id, file_path in manifest.get_files(kind).items():
+                file_stat = file_path.stat()
+                self.size += file_stat.st_size
+                if (kind, video_id) in self.in_bucket and file_path != keep:
+                    files.append((file_stat.st_mtime, file_stat.st_size, kind, video_id, file_path))
+
+        for _, file_size, kind, video_id, file_path in sorted(files):
+            if self.size <= self.max_bytes:
+                break
+            manifest.remove(kind, video_id, file_path)
+            file_path.unlink(missing_ok=True)
+            self.size -= file_size
+            self.evictions += 1
+
+    def stats(self) -> str:
+        return (
+            f"Artifacts read-through cache: {self.downloads} downloads, {self.evictions} evictions"
+        )
+
+
+read_through = ArtifactsReadThrough(ARTIFACTS_LOCAL_PATHS, ARTIFACTS_S3_PATHS)
 
 
-def summary_in_local_files(video_info: VideoInfoP) -> bool:
-    file_path = SUMMARIES_LOCAL_PATH / get_file_name(video_info)
-    return file_path.is_file()
-
+def video_id_local_file(video_id: VideoID) -> Path | None:
+    return manifest.get("transcripts", video_id)
+
+
+@functools.cache
+def get_store() -> store.ArtifactStore | None:
+    """The sqlite store if it is the configured artifacts backend, None for json files."""
+    if get_data_config()["artifacts_backend"] != "sqlite":
+        return None
+    return store.ArtifactStore(STORE_LOCAL_FILE)
+
+
+def get_store_date(date: pendulum.DateTime | str) -> str:
+    if isinstance(date, str):
+        date = pendulum.parse(date)
+    return date.in_tz("UTC").to_iso8601_string()
+
+
+def get_state_record(state: dict) -> store.Record:
+    date = get_store_date(state["date"]) if "date" in state else None
+    return store.Record(state["id"], state.get("channel_id", state["id"]), date, state)
+
 
-def story_in_local_files(video_info: VideoInfoP) -> bool:
-    file_path = STORIES_LOCAL_PATH / get_file_name(video_info)
-    return file_path.is_file()
+def get_artifact_record(kind: str, data: dict) -> store.Record:
+    video_info = data[ARTIFACTS_VIDEO_INFO_KEYS[kind]]
+    return store.Record(
+        video_info["id"], video_info["channel_id"], get_store_date(video_info["date"]), data
+    )
+
+
+def get_artifact_path(kind: str, data: dict) -> Path:
+    """Path of the artifact file, relative to the folder of its kind."""
+    video_info = data[ARTIFACTS_VIDEO_INFO_KEYS[kind]]
+    date = pendulum.parse(video_info["date"]).date()
+    extension = get_artifacts_extensions()[kind]
+    return Path(get_partition(kind, date)) / f"{date}.{video_info['id']}{extension}"
+
+
+@functools.cache
+def get_artifacts_extensions() -> dict[str, str]:
+    return get_data_config()["artifacts_extensions"]
+
+
+def artifact_exists(kind: str, video_info: VideoInfoP) -> bool:
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        return artifacts_store.contains(kind, video_info.id)
+    if manifest.get(kind, video_info.id, get_partition(kind, video_info.date.date())) is not None:
+        return True
+    return read_through.enabled and read_through.contains(kind, video_info)
+
+
+def stamp_schema_version(data: dict) -> dict:
+    return data | {"schema_version": SCHEMA_VERSION}
+
+
+def save_artifact(kind: str, data: dict) -> None:
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        artifacts_store.upsert(kind, [get_artifact_record(kind, data)])
+        return
+    video_id = data[ARTIFACTS_VIDEO_INFO_KEYS[kind]]["id"]
+    file_path = ARTIFACTS_LOCAL_PATHS[kind] / get_artifact_path(kind, data)
+    file_path.parent.mkdir(exist_ok=True)
+    save_to_json_file(data, file_path)
+    # a file saved with an extension that is no longer configured is replaced
+    previous_file_path = manifest.get(kind, video_id, manifest.get_partition(kind, file_path))
+    if previous_file_path is not None and previous_file_path != file_path:
+        previous_file_path.unlink(missing_ok=True)
+    manifest.add(kind, video_id, file_path)
+    if read_through.enabled:
+        read_through.store(kind, video_id, file_path)
+
+
+def load_artifact(kind: str, video_info: VideoInfoP) -> dict:
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        return artifacts_store.get(kind, video_info.id)
+    if read_through.enabled:
+        return read_through.load(kind, video_info)
+    partition = get_partition(kind, video_info.date.date())
+    file_path = manifest.get(kind, video_info.id, partition)
+    if file_path is None:
+        file_path = ARTIFACTS_LOCAL_PATHS[kind] / partition / get_file_name(video_info)
+    return load_from_json_file(file_path)
+
+
+def load_artifacts(kind: str, since: pendulum.DateTime | None = None) -> list[dict]:
+    """Every artifact of a kind, optionally only those of videos published since a date."""
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        since = get_store_date(since) if since is not None else None
+        return [record.data for record in artifacts_store.query(kind, since=since)]
+
+    if read_through.enabled:
+        return read_through.load_since(kind, since)
+
+    partitions = get_partitions_since(kind, since) if since is not None else None
+    files_paths = sorted(manifest.get_files(kind, partitions).values())
+    if since is not None:
+        # file names start with the video date
+        since_date = since.in_tz("UTC").to_date_string()
+        files_paths = [file_path for file_path in files_paths if file_path.name[:10] >= since_date]
+    return [load_from_json_file(file_path) for file_path in files_paths]
+
+
+def save_state(name: str, states: list[dict]) -> None:
+    states = [stamp_schema_version(state) for state in states]
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        artifacts_store.replace(name, [get_state_record(state) for state in states])
+        return
+    write_json_state(name, states)
+
+
+def write_json_state(name: str, states: list[dict]) -> None:
+    """Items are written as they are, with the schema version they were stamped with (if any)."""
+    save_to_json_file(states, STATES_LOCAL_FILES[name])
+    # the changes log is emptied rather than removed, so that its copy in the bucket is too
+    if name in STATES_CHANGES_LOCAL_FILES and STATES_CHANGES_LOCAL_FILES[name].is_file():
+        STATES_CHANGES_LOCAL_FILES[name].write_bytes(b"")
+
+
+def update_state(name: str, changed_states: list[dict], removed_ids: list[str]) -> None:
+    """Write only the changed and removed items of a state. With json files, the changes are
+    appended to a log that is applied and compacted when the state is loaded."""
+    changed_states = [stamp_schema_version(state) for state in changed_states]
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        with artifacts_store.transaction() as connection:
+            store.upsert_records(
+                connection, name, [get_state_record(state) for state in changed_states]
+            )
+            store.delete_records(connection, name, removed_ids)
+        return
+    changes = [{"id": id, "removed": True} for id in removed_ids]
+    changes += [{"id": state["id"], "state": state} for state in changed_states]
+    extend_jsonl_file(changes, STATES_CHANGES_LOCAL_FILES[name])
+    # the first changes of a state are written as its base file, which is always pushed
+    if not STATES_LOCAL_FILES[name].is_file():
+        write_json_state(name, load_json_state(name))
+
+
+def load_state(name: str) -> list[dict]:
+    artifacts_store = get_store()
+    if artifacts_store is not None:
+        return [record.data for record in artifacts_store.query(name)]
+    return load_json_state(name)
+
+
+def load_json_state(name: str) -> list[dict]:
+    states = []
+    if STATES_LOCAL_FILES[name].is_file():
+        states = load_from_json_file(STATES_LOCAL_FILES[name])
+    changes_file_path = STATES_CHANGES_LOCAL_FILES.get(name)
+    if changes_file_path is None or not changes_file_path.is_file():
+        return states
+
+    states = {state["id"]: state for state in states}
+    changes = load_from_jsonl_file(changes_file_path)
+    for change in changes:
+        if change.get("removed"):
+            states.pop(change["id"], None)
+        else:
+            states[change["id"]] = change["state"]
+    states = list(states.values())
+    # compacted once the log outgrows the state, items that were not validated keep their stamp
+    if len(changes) > max(len(states), get_data_config()["states_changes_max_lines"]):
+        write_json_state(name, states)
+    return states
+
+
+def copy_object_to_partition(bucket_name: str, kind: str, s3_path: str) -> None:
+    file_name = Path(s3_path).name
+    partition = get_partition(kind, pendulum.parse(file_name[:10]).date())
+    s3.meta.client.copy(
+        {"Bucket": bucket_name, "Key": s3_path},
+        bucket_name,
+        get_artifacts_s3_path(kind, partition) + file_name,
+    )
+
+
+def partition_artifacts(bucket_name: str | None = None) -> None:
+    """Move the artifacts saved before their kind was partitioned into their partition folder,
+    locally and in the bucket if given."""
+    for kind in PARTITIONED_ARTIFACTS:
+        local_path = ARTIFACTS_LOCAL_PATHS[kind]
+        moved = 0
+        for entry in os.scandir(local_path) if local_path.is_dir() else []:
+            if entry.is_file() and entry.name.endswith(JSON_EXTENSIONS):
+                partition = get_partition(kind, pendulum.parse(entry.name[:10]).date())
+                (local_path / partition).mkdir(exist_ok=True)
+                os.replace(entry.path, local_path / partition / entry.name)
+                moved += 1
+        print(f"    > {kind}: {moved} local files moved to their partition")
+        if bucket_name is None:
+            continue
+
+        # with the delimiter, only the keys that are not in a partition yet are listed
+        s3_paths = [
+            s3_object["Key"]
+            for s3_object in list_bucket_objects(
+                bucket_name, prefix=ARTIFACTS_S3_PATHS[kind], delimiter="/"
+            )
+            if s3_object["Key"].endswith(JSON_EXTENSIONS)
+        ]
+        concurrency.thread_map(
+            functools.partial(copy_object_to_partition, bucket_name, kind),
+            s3_paths,
+            get_data_config()["s3_max_workers"],
+        )
+        for idx in range(0, len(s3_paths), 1000):
+            s3.meta.client.delete_objects(
+                Bucket=bucket_name,
+                Delete={"Objects": [{"Key": s3_path} for s3_path in s3_paths[idx : idx + 1000]]},
+            )
+        print(f"    > {kind}: {len(s3_paths)} files moved to their partition in {bucket_name}")
+    manifest.reset()
+
+
+def import_json_to_store() -> None:
+    """Copy the json states and artifacts into the sqlite store file."""
+    artifacts_store = store.ArtifactStore(STORE_LOCAL_FILE)
+    for name, file_path in STATES_LOCAL_FILES.items():
+        if file_path.is_file():
+            states = load_json_state(name)
+            artifacts_store.replace(name, [get_state_record(state) for state in states])
+    for kind in ARTIFACTS_LOCAL_PATHS:
+        artifacts_store.upsert(
+            kind,
+            [
+                get_artifact_record(kind, load_from_json_file(file_path))
+                for file_path in manifest.get_files(kind).values()
+            ],
+        )
+    for name in list(STATES_LOCAL_FILES) + list(ARTIFACTS_LOCAL_PATHS):
+        print(f"    > {name}: {artifacts_store.count(name)} items in store")
+    artifacts_store.close()
+
+
+def export_store_to_json() -> None:
+    """Write the content of the sqlite store file back to the json layout."""
+    artifacts_store = store.ArtifactStore(STORE_LOCAL_FILE)
+    for name, file_path in STATES_LOCAL_FILES.items():
+        save_to_json_file([record.data for record in artifacts_store.query(name)], file_path)
+    for kind, local_path in ARTIFACTS_LOCAL_PATHS.items():
+        records = artifacts_store.query(kind)
+        for record in records:
+            file_path = local_path / get_artifact_path(kind, record.data)
+            file_path.parent.mkdir(exist_ok=True)
+            save_to_json_file(record.data, file_path)
+        print(f"    > {kind}: {len(records)} items exported")
+    artifacts_store.close()
+
+
+def serialize_json(data: Any, indent: bool) -> bytes:
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+
+
+def save_to_json_file(data: Any, file_path: Path | str) -> None:
+    """The format is picked from the extension: .json files are indented, .json.gz and .json.zst
+    files are compact and compressed. Files are replaced atomically, an interrupted run never
+    leaves a truncated file behind."""
+    file_path = Path(file_path)
+    if file_path.name.endswith(".gz"):
+        # without a timestamp, the same data always gives the same file and ETag
+        content = gzip.compress(serialize_json(data, indent=False), mtime=0)
+    elif file_path.name.endswith(".zst"):
+        content = zstandard.ZstdCompressor().compress(serialize_json(data, indent=False))
+    else:
+        content = serialize_json(data, indent=True)
+    temp_file_path = file_path.with_name(f".{file_path.name}.{threading.get_ident()}.tmp")
+    with open(temp_file_path, "wb") as file:
+        file.write(content)
+    os.replace(temp_file_path, file_path)
+
+
+def append_to_jsonl_file(data: Any, file_path: Path) -> None:
+    with open(file_path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(data) + "\n")
+
+
+def extend_jsonl_file(items: list[Any], file_path: Path) -> None:
+    with open(file_path, "a", encoding="utf-8") as file:
+        file.write("".join(json.dumps(item) + "\n" for item in items))
+
+
+def load_from_jsonl_file(file_path: Path) -> list[Any]:
+    with open(file_path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
 
 
-def save_to_json_file(data: Any, file_path: Path) -> None:
-    with open(file_path, "w", encoding="utf-8") as file:
-        json.dump(data, file, indent=4)
+def load_from_json_content(content: bytes, file_name: str) -> Any:
+    if file_name.endswith(".gz"):
+        content = gzip.decompress(content)
+    elif file_name.endswith(".zst"):
+        content = zstandard.ZstdDecompressor().decompress(content)
+    return orjson.loads(content)
 
 
-def load_from_json_file(file_path: Path) -> Any:
-    with open(file_path, encoding="utf-8") as file:
-        return json.load(file)
+def load_from_json_file(file_path: Path | str) -> Any:
+    file_path = Path(file_path)
+    with open(file_path, "rb") as file:
+        content = file.read()
+    return load_from_json_content(content, file_path.name)
 
 
 def load_html_template(template_name: str) -> str:
@@ -0,0 +1,166 @@
+"""SQLite store for the pipeline state and artifacts, kept in a single file.
+
+Every record belongs to a collection (channels, videos, transcripts, summaries, stories) and is
+indexed by its id, channel id and date. Dates are stored as UTC iso strings so that range queries
+can compare them directly.
+
+Run `python -m inews.infra.store import` to fill the store from the json layout, and
+`python -m inews.infra.store export` to write it back.
+"""
+
+import json
+import sqlite3
+import threading
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, NamedTuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    channel_id TEXT,
+    date TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS records_date ON records (collection, date);
+CREATE INDEX IF NOT EXISTS records_channel ON records (collection, channel_id);
+"""
+
+
+class Record(NamedTuple):
+    id: str
+    channel_id: str | None
+    date: str | None
+    data: Any
+
+
+def upsert_records(
+    connection: sqlite3.Connection, collection: str, records: Iterable[Record]
+) -> None:
+    connection.executemany(
+        "INSERT INTO records (collection, id, channel_id, date, data) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (collection, id) DO UPDATE SET "
+        "channel_id = excluded.channel_id, date = excluded.date, data = excluded.data",
+        [
+            (collection, record.id, record.channel_id, record.date, json.dumps(record.data))
+            for record in records
+        ],
+    )
+
+
+def delete_records(connection: sqlite3.Connection, collection: str, ids: Iterable[str]) -> None:
+    connection.executemany(
+        "DELETE FROM records WHERE collection = ? AND id = ?", [(collection, id) for id in ids]
+    )
+
+
+class ArtifactStore:
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        self.connection = None
+        # connections are shared by the pipeline threads, statements are serialized
+        self.lock = threading.RLock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.file_path, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                yield connection
+
+    def upsert(self, collection: str, records: Iterable[Record]) -> None:
+        with self.transaction() as connection:
+            upsert_records(connection, collection, records)
+
+    def replace(self, collection: str, records: Iterable[Record]) -> None:
+        """Upsert records and delete the ones of the collection that are not among them, in a
+        single transaction."""
+        records = list(records)
+        with self.transaction() as connection:
+            upsert_records(connection, collection, records)
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS kept_ids (id TEXT PRIMARY KEY)")
+            connection.execute("DELETE FROM kept_ids")
+            connection.executemany(
+                "INSERT OR IGNORE INTO kept_ids VALUES (?)", [(record.id,) for record in records]
+            )
+            connection.execute(
+                "DELETE FROM records WHERE collection = ? AND id NOT IN (SELECT id FROM kept_ids)",
+                (collection,),
+            )
+
+    def fetch(self, query: str, params: Iterable[Any]) -> list[tuple]:
+        with self.lock:
+            return self.connect().execute(query, tuple(params)).fetchall()
+
+    def get(self, collection: str, id: str) -> Any | None:
+        rows = self.fetch(
+            "SELECT data FROM records WHERE collection = ? AND id = ?", (collection, id)
+        )
+        return json.loads(rows[0][0]) if len(rows) > 0 else None
+
+    def contains(self, collection: str, id: str) -> bool:
+        rows = self.fetch("SELECT 1 FROM records WHERE collection = ? AND id = ?", (collection, id))
+        return len(rows) > 0
+
+    def query(
+        self,
+        collection: str,
+        since: str | None = None,
+        until: str | None = None,
+        channel_id: str | None = None,
+    ) -> list[Record]:
+        """Records of a collection ordered by date, optionally within [since, until) and for a
+        single channel."""
+        query = "SELECT id, channel_id, date, data FROM records WHERE collection = ?"
+        params = [collection]
+        if since is not None:
+            query += " AND date >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND date < ?"
+            params.append(until)
+        if channel_id is not None:
+            query += " AND channel_id = ?"
+            params.append(channel_id)
+        query += " ORDER BY date, id"
+
+        rows = self.fetch(query, params)
+        return [
+            Record(id, channel_id, date, json.loads(data)) for id, channel_id, date, data in rows
+        ]
+
+    def count(self, collection: str) -> int:
+        rows = self.fetch("SELECT COUNT(*) FROM records WHERE collection = ?", (collection,))
+        return rows[0][0]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from inews.infra import io
+
+    parser = argparse.ArgumentParser(prog="Artifacts store")
+    parser.add_argument("command", choices=["import", "export"])
+    args = parser.parse_args()
+
+    io.make_data_dirs()
+    if args.command == "import":
+        io.import_json_to_store()
+    else:
+        io.export_store_to_json()
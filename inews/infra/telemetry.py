@@ -0,0 +1,54 @@
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+import pendulum
+
+from inews.infra import io
+
+
+class CallsLedger:
+    """Append-only jsonl ledger of llm calls, records of the current run are kept in memory
+    for the rollup."""
+
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        self.run_id = pendulum.now("UTC").format("YYYYMMDDTHHmmss")
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, **fields) -> None:
+        record = {"run_id": self.run_id, "timestamp": pendulum.now("UTC").isoformat(), **fields}
+        with self.lock:
+            self.records.append(record)
+            io.append_to_jsonl_file(record, self.file_path)
+
+    def rollup(self) -> str:
+        with self.lock:
+            records = list(self.records)
+
+        stages = defaultdict(lambda: defaultdict(float))
+        for record in records:
+            for stage in (record["stage"], "total"):
+                stage_rollup = stages[stage]
+                stage_rollup["calls"] += 1
+                stage_rollup["cached"] += record["cached"]
+                stage_rollup["prompt_tokens"] += record["prompt_tokens"]
+                stage_rollup["completion_tokens"] += record["completion_tokens"]
+                stage_rollup["wall_time"] += record["wall_time"]
+                stage_rollup["retries"] += record["retries"]
+                stage_rollup["retry_wait"] += record["retry_wait"]
+                stage_rollup["cost"] += record["cost"]
+
+        lines = [f"LLM calls rollup (run {self.run_id}):"]
+        stages["total"] = stages.pop("total", defaultdict(float))
+        for stage, stage_rollup in stages.items():
+            lines.append(
+                f"    > {stage}: {stage_rollup['calls']:.0f} calls "
+                + f"({stage_rollup['cached']:.0f} cached), "
+                + f"{stage_rollup['prompt_tokens']:.0f}+{stage_rollup['completion_tokens']:.0f} "
+                + f"tokens, {stage_rollup['wall_time']:.1f}s, "
+                + f"{stage_rollup['retries']:.0f} retries ({stage_rollup['retry_wait']:.1f}s), "
+                + f"${stage_rollup['cost']:.4f}"
+            )
+        return "\n".join(lines)
@@ -1,3 +1,7 @@
+import functools
+import types
+import typing
+from datetime import datetime
 from enum import Enum
 from pprint import pformat
 from typing import Annotated, Any, Callable, Literal, Protocol
@@ -29,6 +33,7 @@ class RunEvent(BaseModel):
     send_test: bool
     pull_from_bucket: bool
     push_to_bucket: bool
+    llm_batch: bool = False
 
 
 class RootModelList(RootModel):
@@ -87,6 +92,103 @@ class _DateTimePydanticAnnotation:
 
 PendulumDateTime = Annotated[pendulum.DateTime, _DateTimePydanticAnnotation]
 
+
+@functools.cache
+def get_fixed_timezone(offset: int) -> datetime.tzinfo:
+    return pendulum.timezone(offset)
+
+
+def parse_datetime(value: str) -> pendulum.DateTime:
+    """Faster than pendulum.instance for the iso strings the models are dumped to."""
+    # utc dates are dumped with a Z suffix, which fromisoformat only accepts from python 3.11
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        return pendulum.parse(value)
+    offset = date.utcoffset()
+    return pendulum.DateTime(
+        date.year,
+        date.month,
+        date.day,
+        date.hour,
+        date.minute,
+        date.second,
+        date.microsecond,
+        tzinfo=get_fixed_timezone(int(offset.total_seconds()) if offset is not None else 0),
+    )
+
+
+def get_converter(annotation: Any) -> Callable[[Any], Any] | None:
+    """Function rebuilding a dumped value of the annotated type, None if it is used as it is."""
+    origin = typing.get_origin(annotation)
+    if origin is Annotated:
+        return get_converter(typing.get_args(annotation)[0])
+    if origin in (typing.Union, types.UnionType):
+        # None values are never converted, other unions are left as they are
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        return get_converter(args[0]) if len(args) == 1 else None
+    if origin is list:
+        item_converter = get_converter(typing.get_args(annotation)[0])
+        if item_converter is None:
+            return None
+        return lambda items: [item_converter(item) for item in items]
+    if origin is dict:
+        value_converter = get_converter(typing.get_args(annotation)[1])
+        if value_converter is None:
+            return None
+        return lambda items: {key: value_converter(item) for key, item in items.items()}
+    if annotation is pendulum.DateTime:
+        return parse_datetime
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return get_trusted_constructor(annotation)
+    return None
+
+
+@functools.cache
+def get_trusted_constructor(model: type[BaseModel]) -> Callable[[dict], BaseModel]:
+    """Function building a model from data it dumped itself, skipping validation. The fields
+    converters are resolved once per model, the instance is set up as model_construct does."""
+    names = list(model.model_fields)
+    converters = [
+        (name, converter)
+        for name, field in model.model_fields.items()
+        if (converter := get_converter(field.annotation)) is not None
+    ]
+    defaults = [
+        (name, field) for name, field in model.model_fields.items() if not field.is_required()
+    ]
+    private_attributes = model.__private_attributes__
+    new = model.__new__
+    setattr = object.__setattr__
+
+    def construct(data: dict) -> BaseModel:
+        values = {name: data[name] for name in names if name in data}
+        fields_set = set(values)
+        for name, converter in converters:
+            value = values.get(name)
+            if value is not None:
+                values[name] = converter(value)
+        if len(values) < len(names):
+            for name, field in defaults:
+                if name not in values:
+                    values[name] = field.get_default(call_default_factory=True)
+            # in the fields order, as validation does
+            values = {name: values[name] for name in names}
+        instance = new(model)
+        setattr(instance, "__dict__", values)
+        setattr(instance, "__pydantic_fields_set__", fields_set)
+        setattr(instance, "__pydantic_extra__", None)
+        private = None
+        if private_attributes:
+            private = {name: attr.get_default() for name, attr in private_attributes.items()}
+        setattr(instance, "__pydantic_private__", private)
+        return instance
+
+    return construct
+
+
 VideoID = Annotated[
     str,
     StringConstraints(
@@ -118,12 +220,17 @@ class ChannelInfoP(Protocol):
     id: ChannelID
     name: str
     uploads_playlist_id: str
+    playlist_etag: str | None
+    last_video_id: VideoID | None
+    last_video_date: pendulum.DateTime | None
 
 
 class ProcessedTranscriptP(Protocol):
     tokens_count: int
     is_generated: bool
-    text: str
+    text: str | None
+
+    def get_text(self) -> str: ...
 
 
 class VideoP(Protocol):
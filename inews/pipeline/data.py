@@ -1,98 +1,138 @@
-import copy
+import functools
 import warnings
 
+import pendulum
+
 from inews.domain import llm, youtube
 from inews.domain.models import (
     ChannelInfo,
+    RunJournal,
     Story,
     Summary,
+    TranscriptsMisses,
     Video,
     VideoInfo,
+    VideosState,
+    load_models,
 )
-from inews.infra import io
-from inews.infra.types import ChannelID, RunEvent
+from inews.infra import concurrency, io
+from inews.infra.types import ChannelID, RunEvent, VideoID
+
+data_config = io.get_data_config()
 
 
 def run(event: RunEvent):
     io.make_data_dirs()
 
     bucket_name = f"inews-{event.stage._value_}"
+    if data_config["artifacts_read_through"] and event.pull_from_bucket:
+        io.read_through.configure_bucket(
+            bucket_name,
+            push=event.push_to_bucket,
+            max_bytes=data_config["artifacts_cache_max_bytes"],
+        )
     if event.pull_from_bucket:
         io.pull_data_from_bucket(bucket_name)
+    if data_config["llm_cache_mirror"]:
+        llm.response_cache.configure_bucket(
+            bucket_name, pull=event.pull_from_bucket, push=event.push_to_bucket
+        )
+    journal = RunJournal.init_for_run()
+    if event.push_to_bucket:
+        journal.configure_bucket(bucket_name, data_config["run_journal_push_interval"])
+    print(journal.stats())
+    llm.batch_requests.configure(event.llm_batch)
+    llm.batch_requests.collect(wait_seconds=data_config["llm_batch_wait"])
 
     channels_ids = io.get_config_channel_ids()
     channels_state = build_channels_state(channels_ids)
-    save_channels_state(channels_state)
-
     videos_state = build_videos_state(channels_state)
+
+    transcripts_misses = TranscriptsMisses.init_from_file()
     for vinfo in videos_state:
-        vinfo.use = vinfo.use and vinfo.is_valid
-    save_videos_state(videos_state)
+        use = vinfo.use or transcripts_misses.is_retry_due(vinfo.id)
+        videos_state.set_use(vinfo.id, use and vinfo.is_valid)
 
     videos = build_videos_from_state(videos_state, channels_state)
+    summaries = build_summaries_from_videos(videos, use_local_files=True)
 
-    transcripts_search = [video for video in videos if video.allow_requests]
-    print(f"Searching transcripts for {len(transcripts_search)} videos")
-    for video in videos:
-        video.get_available_transcript()
-
-    transcripts_found = [
-        video for video in videos if video.transcript is not None and video.allow_requests
-    ]
-    print(f"Found {len(transcripts_found)} transcripts")
+    # each video flows through its own chain of tasks, the only join point is the selection
+    graph = concurrency.TaskGraph(data_config["pipeline_stages_max_workers"])
+    topics_tasks = []
+    for video, summary in zip(videos, summaries, strict=True):
+        video_id = video.info.id
+        transcript_task = graph.add(
+            f"{video_id}/transcript",
+            functools.partial(
+                run_video_step,
+                video,
+                functools.partial(process_transcript, video, transcripts_misses, journal),
+            ),
+            "transcript",
+        )
+        base_task = graph.add(
+            f"{video_id}/base",
+            functools.partial(
+                run_video_step,
+                video,
+                functools.partial(process_base_summary, summary, video, event, journal),
+            ),
+            "base",
+            after=[transcript_task],
+        )
+        topics_task = graph.add(
+            f"{video_id}/topics",
+            functools.partial(
+                run_video_step,
+                video,
+                functools.partial(process_topics, summary, video, event, journal),
+            ),
+            "topics",
+            after=[base_task],
+        )
+        topics_tasks.append(topics_task)
+
+    graph.add(
+        "selection",
+        functools.partial(select_and_schedule_stories, graph, summaries, videos, event, journal),
+        "selection",
+        after=topics_tasks,
+    )
+    print(f"Running pipeline tasks for {len(videos)} videos")
+    graph.run()
+    print(graph.stats())
 
-    for video in videos:
-        video.info.use = video.info.use and video.valid_transcript
+    transcripts_search = [video for video in videos if video.allow_requests]
+    transcripts_found = [video for video in transcripts_search if video.transcript is not None]
+    print(f"Searched transcripts for {len(transcripts_search)} videos")
+    print(f"    > {len(transcripts_found)} transcripts found")
+    transcripts_misses.save()
+    print(f"Transcripts misses saved: {len(transcripts_misses)} items")
 
     videos_info = [video.info for video in videos]
-    videos_state = update_videos_state(videos_state, videos_info)
-    save_videos_state(videos_state)
-
-    videos = [video for video in videos if video.info.use]
-    for video in videos:
-        video.save()
-    print(f"Transcripts saved: {len(videos)} items")
-
-    summaries = build_summaries_from_videos(videos, use_local_files=True)
-    print(f"Getting summaries for {len(summaries)} transcripts")
-    for summary, video in zip(summaries, videos, strict=True):
-        summary.get_base_from_video(video, event)
-        summary.get_topics(event)
-        summary.save()
-    print(f"Summaries saved: {len(summaries)} items")
-
-    print("Selecting relevant stories")
-    summaries_selected = select_relevant_summaries(summaries, event)
-    selected_ids = [summary.video_info.id for summary in summaries_selected]
-    for summary in summaries:
-        summary.video_info.use = summary.video_info.use and summary.video_info.id in selected_ids
-
-    videos_info = [summary.video_info for summary in summaries]
-    videos_state = update_videos_state(videos_state, videos_info)
+    update_videos_state(videos_state, videos_info)
+    # the states are saved once the run is over, an interrupted run polls the channels again
+    save_channels_state(channels_state)
     save_videos_state(videos_state)
+    journal.complete()
 
-    print("Building stories")
-    stories = build_stories_from_summaries(summaries_selected, use_local_files=True)
-    for story, summary in zip(stories, summaries_selected, strict=True):
-        story.get_short_from_summary(summary, event)
-        story.get_title_from_summary(summary, event)
-        story.get_user_groups_from_summary(summary, event)
-        story.save()
-    print(f"Stories saved: {len(stories)} items")
+    print(llm.response_cache.stats())
+    if io.read_through.enabled:
+        print(io.read_through.stats())
+    print(llm.ledger.rollup())
+    llm.batch_requests.submit()
 
     if event.push_to_bucket:
         io.push_data_to_bucket(bucket_name)
 
 
 def build_channels_state(channels_ids: list[ChannelID]) -> list[ChannelInfo]:
-    previous_channels = []
-    previous_ids = []
-    if io.CHANNELS_LOCAL_FILE.is_file():
-        channels_local_file = io.load_from_json_file(io.CHANNELS_LOCAL_FILE)
-        previous_channels = [
-            ChannelInfo(**cinfo) for cinfo in channels_local_file if cinfo["id"] in channels_ids
-        ]
-        previous_ids = [cinfo.id for cinfo in previous_channels]
+    previous_channels = [
+        cinfo
+        for cinfo in load_models(ChannelInfo, io.load_state("channels"))
+        if cinfo.id in channels_ids
+    ]
+    previous_ids = [cinfo.id for cinfo in previous_channels]
 
     new_channels = []
     new_ids = [id for id in channels_ids if id not in previous_ids]
@@ -106,92 +146,148 @@ def build_channels_state(channels_ids: list[ChannelID]) -> list[ChannelInfo]:
     return previous_channels + new_channels
 
 
-def build_videos_state(channels: list[ChannelInfo]) -> list[VideoInfo]:
-    recent_videos_ids = []
-    for channel in channels:
-        ids = youtube.get_channel_recent_videos_ids(channel.uploads_playlist_id, max_results=15)
-        recent_videos_ids += ids
+def poll_channel_new_videos_ids(channel: ChannelInfo) -> list[VideoID]:
+    new_videos, channel.playlist_etag = youtube.get_channel_new_videos(
+        channel.uploads_playlist_id,
+        etag=channel.playlist_etag,
+        last_video_id=channel.last_video_id,
+        max_results=15,
+    )
+    if len(new_videos) > 0:
+        latest_video = new_videos[0]
+        channel.last_video_id = latest_video["id"]
+        if latest_video["date"] is not None:
+            channel.last_video_date = pendulum.parse(latest_video["date"])
+
+    return [video["id"] for video in new_videos]
 
-    previous_videos = []
-    previous_ids = []
-    if io.VIDEOS_LOCAL_FILE.is_file():
-        videos_local_file = io.load_from_json_file(io.VIDEOS_LOCAL_FILE)
-        previous_videos = [
-            VideoInfo(**vinfo) for vinfo in videos_local_file if vinfo["id"] in recent_videos_ids
-        ]
-        previous_ids = [vinfo.id for vinfo in previous_videos]
 
-    new_videos = []
-    new_ids = [id for id in recent_videos_ids if id not in previous_ids]
+def build_videos_state(channels: list[ChannelInfo]) -> VideosState:
+    channels_results = concurrency.thread_map(
+        poll_channel_new_videos_ids, channels, data_config["youtube_max_workers"]
+    )
+    polled_videos_ids = []
+    channels_latencies = []
+    for channel, (ids, latency) in zip(channels, channels_results, strict=True):
+        polled_videos_ids += ids
+        channels_latencies.append(f"    > {channel.name}: {len(ids)} new items in {latency:.2f}s")
+
+    # polling stops at each channel's cursor, previously known videos are kept from the state
+    # file for as long as they are recent
+    channels_ids = {channel.id for channel in channels}
+    polled_ids = set(polled_videos_ids)
+    videos_state = VideosState.init_from_file()
+    for vinfo in videos_state:
+        if vinfo.channel_id not in channels_ids or not (vinfo.id in polled_ids or vinfo.is_recent):
+            videos_state.remove(vinfo.id)
+    previous_count = len(videos_state)
+
+    new_ids = [id for id in polled_videos_ids if id not in videos_state]
     if len(new_ids) > 0:
-        videos_dicts = youtube.get_videos_info(new_ids)
-        new_videos = [VideoInfo.model_validate(_dict) for _dict in videos_dicts]
+        for _dict in youtube.get_videos_info(new_ids):
+            videos_state.add(VideoInfo.model_validate(_dict))
 
-    print(f"Videos State: {len(recent_videos_ids)} items")
-    print(f"    > {len(new_videos)} items fetched from api")
-    print(f"    > {len(previous_videos)} items read from file")
-    return previous_videos + new_videos
+    print(f"Videos State: {len(videos_state)} items")
+    print(f"    > {len(videos_state) - previous_count} items fetched from api")
+    print(f"    > {previous_count} items read from file")
+    print("Channels polling latencies:")
+    print("\n".join(channels_latencies))
+    return videos_state
 
 
 def save_channels_state(channels_state: list[ChannelInfo]) -> None:
-    io.save_to_json_file(
-        [vinfo.model_dump(mode="json") for vinfo in channels_state], io.CHANNELS_LOCAL_FILE
-    )
+    io.save_state("channels", [cinfo.model_dump(mode="json") for cinfo in channels_state])
     print("Channels State saved")
 
 
-def save_videos_state(videos_state: list[VideoInfo]) -> None:
-    io.save_to_json_file(
-        [vinfo.model_dump(mode="json") for vinfo in videos_state], io.VIDEOS_LOCAL_FILE
-    )
-    print("Videos State saved")
+def save_videos_state(videos_state: VideosState) -> None:
+    changes_count = videos_state.changes_count
+    videos_state.flush()
+    print(f"Videos State saved: {changes_count} items changed")
 
 
-def update_videos_state(videos_state: list[VideoInfo], videos: list[VideoInfo]) -> list[VideoInfo]:
-    new_videos_state = copy.deepcopy(videos_state)
-    id_to_idx = {vinfo.id: idx for idx, vinfo in enumerate(videos_state)}
+def update_videos_state(videos_state: VideosState, videos: list[VideoInfo]) -> None:
     for vinfo in videos:
-        idx = id_to_idx[vinfo.id]
-        new_videos_state[idx].use = vinfo.use
+        videos_state.set_use(vinfo.id, vinfo.use)
+        videos_state.set_transcript(vinfo.id, vinfo.transcript)
 
     valid_videos = [vinfo for vinfo in videos_state if vinfo.use]
     print(f"Videos State updated: {len(videos_state)} items")
     print(f"    > {len(valid_videos)} valid videos")
-    return new_videos_state
 
 
 def build_videos_from_state(
-    videos_state: list[VideoInfo], channels_state: list[ChannelInfo]
+    videos_state: VideosState, channels_state: list[ChannelInfo]
 ) -> list[Video]:
     videos_info = [
-        video for video in videos_state if video.use and not io.story_in_local_files(video)
+        video for video in videos_state if video.use and not io.artifact_exists("stories", video)
     ]
     channels_info = {channel.id: channel for channel in channels_state}
 
     videos = []
     read_from_file = 0
+    read_from_state = 0
     initialized = 0
     for video_info in videos_info:
-        if io.video_in_local_files(video_info):
-            videos.append(Video.init_from_file(video_info))
-            read_from_file += 1
-        else:
-            channel_info = channels_info[video_info.channel_id]
+        channel_info = channels_info[video_info.channel_id]
+        # a copy, the state is only changed through update_videos_state
+        video_info = video_info.model_copy()
+        if not io.artifact_exists("transcripts", video_info):
             videos.append(Video(info=video_info, channel_info=channel_info))
             initialized += 1
+        elif video_info.transcript is not None:
+            videos.append(Video.init_from_state(video_info, channel_info))
+            read_from_state += 1
+        else:
+            videos.append(Video.init_from_file(video_info))
+            read_from_file += 1
 
     print(f"Videos built from state: {len(videos)} items")
     print(f"    > {initialized} items initialized")
+    print(f"    > {read_from_state} items read from state (transcript text read lazily)")
     print(f"    > {read_from_file} items read from file")
     return videos
 
 
+def run_video_step(video: Video, step: functools.partial) -> None:
+    """A failing step drops its video, instead of skipping the selection of all the others."""
+    try:
+        step()
+    except Exception as error:
+        print(f"Error: {step.func.__name__} failed for {video.info.id}, video dropped: {error!r}")
+        video.info.use = False
+
+
+def process_transcript(
+    video: Video, transcripts_misses: TranscriptsMisses, journal: RunJournal
+) -> None:
+    """Search and fetch the transcript of a video, unless it is read from file, known to be
+    missing or already searched by the interrupted run."""
+    progress = journal.get(video.info.id)
+    # a used transcript is searched again when its artifact is not available (e.g. a resume on
+    # another instance), unless the base summary it was needed for is already journaled
+    transcript_available = video.transcript is not None or bool(progress.base)
+    if progress.transcript is False or (progress.transcript and transcript_available):
+        video.transcript_miss = progress.transcript_miss
+        transcripts_misses.record(video)
+        video.info.use = video.info.use and progress.transcript
+        return
+
+    if video.allow_requests and not transcripts_misses.is_pending(video.info.id):
+        video.get_available_transcript()
+        transcripts_misses.record(video)
+    video.info.use = video.info.use and video.valid_transcript
+    if video.info.use and video.allow_requests:
+        video.save()
+    journal.record(video.info.id, transcript=video.info.use, transcript_miss=video.transcript_miss)
+
+
 def build_summaries_from_videos(videos: list[Video], use_local_files: bool = True) -> list[Summary]:
     summaries = []
     read_from_file = 0
     initialized = 0
     for video in videos:
-        if io.summary_in_local_files(video.info) and use_local_files:
+        if io.artifact_exists("summaries", video.info) and use_local_files:
             summaries.append(Summary.init_from_file(video.info))
             read_from_file += 1
         else:
@@ -204,6 +300,74 @@ def build_summaries_from_videos(videos: list[Video], use_local_files: bool = Tru
     return summaries
 
 
+def process_base_summary(
+    summary: Summary, video: Video, event: RunEvent, journal: RunJournal
+) -> None:
+    if not video.info.use:
+        return
+    summary.base = summary.base or journal.get(video.info.id).base
+    if not summary.base:
+        summary.get_base_from_video(video, event)
+        if summary.base:
+            journal.record(video.info.id, base=summary.base)
+
+
+def process_topics(summary: Summary, video: Video, event: RunEvent, journal: RunJournal) -> None:
+    if video.info.use:
+        summary.topics = summary.topics or journal.get(video.info.id).topics
+        if not summary.topics:
+            summary.get_topics(event)
+            if summary.topics:
+                journal.record(video.info.id, topics=summary.topics)
+    if summary.is_complete:
+        summary.save()
+
+
+def select_and_schedule_stories(
+    graph: concurrency.TaskGraph,
+    summaries: list[Summary],
+    videos: list[Video],
+    event: RunEvent,
+    journal: RunJournal,
+) -> None:
+    summaries = [
+        summary for summary, video in zip(summaries, videos, strict=True) if video.info.use
+    ]
+    pending_summaries = [summary for summary in summaries if not summary.is_complete]
+    summaries = [summary for summary in summaries if summary.is_complete]
+    print(f"Summaries saved: {len(summaries)} items")
+    print(f"    > {len(pending_summaries)} items pending in llm batches")
+
+    print("Selecting relevant stories")
+    decisions = {
+        summary.video_info.id: journal.get(summary.video_info.id).selected for summary in summaries
+    }
+    undecided = [summary for summary in summaries if decisions[summary.video_info.id] is None]
+    print(f"    > {len(summaries) - len(undecided)} decisions read from the run journal")
+    undecided_selected_ids = {
+        summary.video_info.id for summary in select_relevant_summaries(undecided, event)
+    }
+    for summary in undecided:
+        decisions[summary.video_info.id] = summary.video_info.id in undecided_selected_ids
+    journal.record_selection(
+        {summary.video_info.id: decisions[summary.video_info.id] for summary in undecided}
+    )
+    summaries_selected = [summary for summary in summaries if decisions[summary.video_info.id]]
+    selected_ids = [summary.video_info.id for summary in summaries_selected]
+    videos_info = {video.info.id: video.info for video in videos}
+    for summary in summaries:
+        video_info = videos_info[summary.video_info.id]
+        video_info.use = video_info.use and summary.video_info.id in selected_ids
+
+    stories = build_stories_from_summaries(summaries_selected, journal, use_local_files=True)
+    for story, summary in zip(stories, summaries_selected, strict=True):
+        graph.add(
+            f"{summary.video_info.id}/story",
+            functools.partial(process_story, story, summary, event, journal),
+            "story",
+        )
+
+
 def select_relevant_summaries(summaries: list[Summary], event: RunEvent) -> list[Summary]:
     if len(summaries) == 0:
         return []
@@ -229,18 +393,49 @@ def select_relevant_summaries(summaries: list[Summary], event: RunEvent) -> list
     return relevant_summaries
 
 
+def process_story(story: Story, summary: Summary, event: RunEvent, journal: RunJournal) -> None:
+    """Generate the story fields, all at once if structured generation is enabled, then one by one
+    for the fields that are still missing, recording each of them in the run journal."""
+    if data_config["structured_story_generation"]:
+        story.get_all_from_summary(summary, event)
+        record_story_progress(story, journal)
+    for get_field in [
+        story.get_short_from_summary,
+        story.get_title_from_summary,
+        story.get_user_groups_from_summary,
+    ]:
+        get_field(summary, event)
+        record_story_progress(story, journal)
+    if story.is_complete:
+        story.save()
+
+
+def record_story_progress(story: Story, journal: RunJournal) -> None:
+    if story.allow_requests:
+        fields = story.model_dump(mode="json", include={"short", "title", "user_stories"})
+        journal.record(story.video_info.id, story=fields)
+
+
 def build_stories_from_summaries(
-    summaries: list[Summary], use_local_files: bool = True
+    summaries: list[Summary], journal: RunJournal, use_local_files: bool = True
 ) -> list[Story]:
     stories = []
     read_from_file = 0
     initialized = 0
     for summary in summaries:
-        if io.story_in_local_files(summary.video_info) and use_local_files:
+        if io.artifact_exists("stories", summary.video_info) and use_local_files:
             stories.append(Story.init_from_file(summary.video_info))
             read_from_file += 1
         else:
-            stories.append(Story(video_info=summary.video_info, channel_info=summary.channel_info))
+            # with the fields generated by the interrupted run, if any
+            story_fields = journal.get(summary.video_info.id).story
+            stories.append(
+                Story(
+                    video_info=summary.video_info,
+                    channel_info=summary.channel_info,
+                    **story_fields,
+                )
+            )
             initialized += 1
 
     print(f"Stories built from summaries: {len(stories)} items")
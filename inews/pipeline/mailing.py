@@ -1,12 +1,11 @@
-from pathlib import Path
-
 import pendulum
 
 from inews.domain import llm
-from inews.domain.models import MCCampaign, Newsletter, NewsletterInfo, Story
+from inews.domain.models import MCCampaign, Newsletter, NewsletterInfo, RunJournal, Story
 from inews.infra import io
 from inews.infra.types import RunEvent
 
+data_config = io.get_data_config()
 mailing_config = io.get_mailing_config()
 
 
@@ -43,18 +42,33 @@ def run(event: RunEvent):
 
 
 def build_newsletters(today: pendulum.DateTime, event: RunEvent) -> list[Newsletter]:
-    stories = get_stories_from_data_folder(io.STORIES_LOCAL_PATH)
+    stories = get_recent_stories(today)
     stories.sort(key=lambda x: x.video_info.date, reverse=True)
 
-    print("Getting newsletter summary")
-    summary = llm.get_newsletter_summary(stories, event)
+    newsletter_info = NewsletterInfo(date=today, stories=stories)
+    issue_number = newsletter_info.issue_number
+    stories_ids = [story.video_info.id for story in stories]
+    journal = RunJournal.init_from_file()
+    if event.push_to_bucket:
+        journal.configure_bucket(f"inews-{event.stage._value_}", push_interval=0)
+    newsletter_info.summary = journal.get_newsletter_summary(issue_number, stories_ids)
+
+    if newsletter_info.summary:
+        print("Newsletter summary read from the run journal")
+    else:
+        print("Getting newsletter summary")
+        newsletter_info.summary = llm.get_newsletter_summary(stories, event)
+        journal.record_newsletter_summary(issue_number, stories_ids, newsletter_info.summary)
+        print(llm.response_cache.stats())
+        print(llm.ledger.rollup())
 
-    newsletter_info = NewsletterInfo(date=today, summary=summary, stories=stories)
     newsletter_info.save()
 
     if event.push_to_bucket:
         bucket_name = f"inews-{event.stage._value_}"
         io.push_newsletters_to_bucket(bucket_name)
+        if io.LLM_LEDGER_LOCAL_FILE.is_file():
+            io.push_file_to_bucket(bucket_name, io.LLM_LEDGER_LOCAL_FILE, io.LLM_LEDGER_S3_FILE)
 
     print("Building all newsletter versions")
     newsletters = []
@@ -68,10 +82,10 @@ def build_newsletters(today: pendulum.DateTime, event: RunEvent) -> list[Newslet
     return newsletters
 
 
-def get_stories_from_data_folder(data_folder: Path) -> list[Story]:
+def get_recent_stories(today: pendulum.DateTime) -> list[Story]:
+    since = today.subtract(days=data_config["newsletter_stories_days_old"])
     stories = []
-    for file_path in data_folder.rglob("*.json"):
-        json_data = io.load_from_json_file(file_path)
+    for json_data in io.load_artifacts("stories", since=since):
         story = Story.model_validate(json_data)
         if story.is_too_old():
             continue